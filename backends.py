@@ -0,0 +1,54 @@
+import os
+
+import util
+
+# backends.py: the backends jobs can be run on, by name, for the --backend
+# options of exp and parse. A backend provides run(node), which starts a
+# job, and get_state(node), which returns its (state, return code); see
+# dag for the optional extras (wait, refresh, run_many). Backends that
+# don't run jobs on this machine also provide budget(), the resources
+# they make available, which is scheduled against instead of the
+# machine's (see resource_budget).
+#
+# The default is local, or whatever the EXP_BACKEND environment variable
+# names.
+
+# name -> (module, class)
+BACKENDS = {
+    'local': ('local_backend', 'local_backend'),
+    'torque': ('torque', 'torque_backend'),
+    'forkserver': ('forkserver_backend', 'forkserver_backend'),
+    'remote': ('remote_backend', 'remote_backend'),
+}
+
+DEFAULT_BACKEND = 'local'
+
+def default_backend():
+    return os.environ.get('EXP_BACKEND', DEFAULT_BACKEND)
+
+def make_backend(name=None):
+    if name is None:
+        name = default_backend()
+    if name not in BACKENDS:
+        print 'Unknown backend {}; choose one of {}'.format(
+            name, ', '.join(sorted(BACKENDS)))
+        exit(1)
+    module, cls = BACKENDS[name]
+    # only import the backend that is used
+    return getattr(__import__(module), cls)()
+
+def resource_budget(backend, max_cores=None, max_memory=None):
+    """The budget to schedule jobs on backend against: what the backend
+    makes available, unless overridden"""
+    budget = util.resource_budget(max_cores, max_memory)
+    if hasattr(backend, 'budget'):
+        available = backend.budget()
+        if max_cores is None:
+            budget['cores'] = available['cores']
+        if max_memory is None:
+            budget['memory'] = available['memory']
+    return budget
+
+def add_argument(parser):
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='where to run jobs (default: {})'.format(default_backend()))
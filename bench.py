@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import subprocess
+
+import util, serialize, exp_common, dag
+
+# bench.py: benchmarks of the store operations on the interactive path.
+#
+#   bench.py [--sizes 1k,10k,100k] [--depth 3] [--fan-in 2] ...
+#
+# For each size, a synthetic store is generated in a temporary git
+# repository: experiments in --depth stages, those in each stage after the
+# first depending on --fan-in experiments of the previous one, with
+# --params parameters of --cardinality distinct values each, a few
+# descriptions per stage and a fraction of failed experiments (so some
+# have broken dependencies).
+#
+# Each operation (see OPS) is then run --repeat times in a fresh
+# interpreter, as a command would run it; the first run starts with
+# nothing cached in the process, the later ones show what stays cached.
+# Besides the times, the number of processes forked and the bytes read
+# (rchar and read_bytes from /proc/self/io, where available) during the
+# first run are reported. The operations run in the order of OPS, which
+# starts with building the index, so later ones find it on disk.
+#
+# The results are written as JSON to --output (default OUTPUT), to be
+# compared between versions.
+
+OUTPUT = 'bench_output.json'
+
+SCRIPT = os.path.abspath(__file__).replace('.pyc', '.py')
+
+def parse_count(s):
+    """Parse a count such as '1000', '10k' or '1M'"""
+    s = s.strip()
+    units = {'k': 1000, 'm': 1000000}
+    if s and s[-1].lower() in units:
+        return int(float(s[:-1]) * units[s[-1].lower()])
+    return int(s)
+
+
+# Generating stores
+
+def generate(root, n, depth=3, fan_in=2, cardinality=10, nparams=3,
+             descriptions=4, commits=20, fail_rate=0.02, seed=0):
+    """Write the descr files of n synthetic experiments under root, which
+    is made a git repository"""
+    rng = random.Random(seed)
+    subprocess.check_call(['git', 'init', '-q', root])
+    resultsdir = os.path.join(root, exp_common.RESULTS_DIR)
+    os.makedirs(resultsdir)
+
+    commit_pool = [util.sha1('commit {}'.format(i)) for i in range(commits)]
+    date = time.time() - 365 * 24 * 3600
+    prev = []
+    for stage in range(depth):
+        count = n // depth + (1 if stage < n % depth else 0)
+        hashes = []
+        for i in range(count):
+            desc = 'stage{}-{}'.format(stage, i % descriptions)
+            params = dict(('p{}'.format(j), float(rng.randrange(cardinality)))
+                          for j in range(nparams))
+            deps = set(rng.sample(prev, min(fan_in, len(prev))))
+            hsh = util.sha1('{} {} {}'.format(desc, sorted(params.items()), i))
+            failed = rng.random() < fail_rate
+            date += rng.uniform(1, 60)
+            command = './run.sh {} {{}}'.format(
+                ' '.join('{{:p{}}}'.format(j) for j in range(nparams)))
+            if deps:
+                command += ' {{stage{}-0}}'.format(stage - 1)
+            info = {
+                'description': desc,
+                'command': command,
+                'final_command': './run.sh {} {}'.format(
+                    ' '.join(str(v) for v in params.values()),
+                    os.path.join(resultsdir, hsh)),
+                'code': None,
+                'final_code': None,
+                'commit': rng.choice(commit_pool),
+                'date': date,
+                'date_end': date + rng.uniform(1, 3600),
+                'deps': deps,
+                'params': params,
+                'resources': {'cores': 1, 'memory': 0, 'exclusive': False},
+                'return_code': 1 if failed else 0,
+                'run_state': dag.RUN_STATE_FAIL if failed else dag.RUN_STATE_SUCCESS,
+                'working_dir': '.',
+            }
+            os.mkdir(os.path.join(resultsdir, hsh))
+            with open(os.path.join(resultsdir, hsh, exp_common.DESCR_FILE), 'w') as f:
+                f.write(serialize.dumps(info))
+            hashes.append(hsh)
+        prev = hashes
+
+def store_size(root):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, exp_common.DOT_DIR)):
+        total += sum(os.lstat(os.path.join(dirpath, f)).st_size for f in filenames)
+    return total
+
+
+# The operations, run in the store's directory by run_op
+
+def _rebuild(arg):
+    import exp_index
+    exp_index.rebuild()
+
+def _read_descrs(arg):
+    exp_common.read_descrs()
+
+def _find(arg):
+    exp_common.find(arg)
+
+def _find_latest(arg):
+    exp_common.find_latest(arg)
+
+def _list_descrs(arg):
+    import exp
+    exp.list_descrs(exp_common.read_descrs(keep_unreadable=True))
+
+def _show_exp(arg):
+    import exp
+    exp.show_exp(argparse.Namespace(exp=[arg], usage=False))
+
+def _broken_deps(arg):
+    import exp_index
+    exp_index.broken_deps()
+
+OPS = [
+    ('rebuild', _rebuild),
+    ('broken_deps', _broken_deps),
+    ('read_descrs', _read_descrs),
+    ('find', _find),
+    ('find_latest', _find_latest),
+    ('list_descrs', _list_descrs),
+    ('show_exp', _show_exp),
+]
+
+def read_io():
+    try:
+        with open('/proc/self/io') as f:
+            return dict((k, int(v)) for k, v in
+                        (line.split(':') for line in f if ':' in line))
+    except IOError:
+        return None
+
+def count_forks():
+    """Count the processes started from here on, returning a list holding
+    the count"""
+    count = [0]
+    def counted(f):
+        def g(*args, **kwargs):
+            count[0] += 1
+            return f(*args, **kwargs)
+        return g
+    # subprocess forks with os.fork
+    for name in ('fork', 'system', 'popen'):
+        setattr(os, name, counted(getattr(os, name)))
+    return count
+
+def run_op(name, arg, repeat):
+    """Run an operation in this process, printing the measurements as
+    JSON"""
+    op = dict(OPS)[name]
+    out = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    forks = count_forks()
+
+    times = []
+    for i in range(repeat):
+        io = read_io()
+        start = time.time()
+        op(arg)
+        times.append(time.time() - start)
+        if i == 0:
+            result = {'forks': forks[0]}
+            end_io = read_io()
+            if io is not None and end_io is not None:
+                result['rchar'] = end_io['rchar'] - io['rchar']
+                result['read_bytes'] = end_io['read_bytes'] - io['read_bytes']
+
+    sys.stdout = out
+    result['seconds'] = times
+    print json.dumps(result)
+
+def bench_ops(root, arg, repeat):
+    results = {}
+    with open(os.devnull, 'w') as null:
+        for name, op in OPS:
+            p = subprocess.Popen([sys.executable, SCRIPT, '--op', name,
+                                  '--arg', arg, '--repeat', str(repeat)],
+                                 cwd=root, stdout=subprocess.PIPE, stderr=null)
+            out = p.communicate()[0]
+            if p.returncode != 0:
+                print '{} failed'.format(name)
+                results[name] = None
+                continue
+            results[name] = json.loads(out.splitlines()[-1])
+    return results
+
+def report(size, generate_seconds, ops):
+    print '{} experiments (generated in {:.1f}s)'.format(size, generate_seconds)
+    print '  {:12} {:>9} {:>9} {:>6} {:>12}'.format('operation', 'first', 'best', 'forks', 'bytes read')
+    for name, op in OPS:
+        r = ops[name]
+        if r is None:
+            print '  {:12} failed'.format(name)
+            continue
+        print '  {:12} {:8.3f}s {:8.3f}s {:6} {:>12}'.format(
+            name, r['seconds'][0], min(r['seconds']), r['forks'], r.get('rchar', '?'))
+
+def main(args):
+    sizes = [parse_count(s) for s in args.sizes.split(',')]
+    config = dict((k, getattr(args, k)) for k in
+                  ('depth', 'fan_in', 'cardinality', 'params', 'descriptions',
+                   'fail_rate', 'repeat', 'seed'))
+    output = {'date': time.time(), 'python': sys.version.split()[0],
+              'config': config, 'runs': []}
+
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix='exp-bench-', dir=args.dir)
+        try:
+            start = time.time()
+            generate(root, size, args.depth, args.fan_in, args.cardinality,
+                     args.params, args.descriptions, fail_rate=args.fail_rate,
+                     seed=args.seed)
+            generate_seconds = time.time() - start
+            ops = bench_ops(root, 'stage{}-0'.format(args.depth - 1), args.repeat)
+            output['runs'].append({'size': size, 'generate_seconds': generate_seconds,
+                                   'store_bytes': store_size(root), 'ops': ops})
+            report(size, generate_seconds, ops)
+        finally:
+            if args.keep:
+                print '  store kept in ' + root
+            else:
+                shutil.rmtree(root)
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=1, sort_keys=True)
+        f.write('\n')
+    print 'Results written to ' + args.output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark store operations on synthetic stores')
+    parser.add_argument('--sizes', default='1k,10k', help='comma separated numbers of experiments, e.g. 1k,100k,1M (default 1k,10k)')
+    parser.add_argument('--depth', type=int, default=3, help='stages of dependencies (default 3)')
+    parser.add_argument('--fan-in', type=int, default=2, help='dependencies of each experiment after the first stage (default 2)')
+    parser.add_argument('--cardinality', type=int, default=10, help='distinct values of each parameter (default 10)')
+    parser.add_argument('--params', type=int, default=3, help='parameters of each experiment (default 3)')
+    parser.add_argument('--descriptions', type=int, default=4, help='descriptions per stage (default 4)')
+    parser.add_argument('--fail-rate', type=float, default=0.02, help='fraction of failed experiments (default 0.02)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each operation (default 3)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dir', help='where to generate the stores (default: the temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated stores')
+    parser.add_argument('-o', '--output', default=OUTPUT, help='file to write the results to as JSON (default {})'.format(OUTPUT))
+    parser.add_argument('--op', help=argparse.SUPPRESS)
+    parser.add_argument('--arg', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.op:
+        run_op(args.op, args.arg, args.repeat)
+    else:
+        main(args)
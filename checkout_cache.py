@@ -0,0 +1,213 @@
+import os
+import errno
+import json
+import shutil
+import stat
+import pipes
+
+import util, exp_common
+
+# checkout_cache.py: a cache of extracted commits, shared by all jobs.
+#
+# Each commit (or subdirectory of a commit, for --subdir-only) is
+# extracted with git archive once, into .exp/checkouts/<key>/tree, and
+# each job's working directory is copied from the cached tree, which is
+# much cheaper than extracting the commit again.
+#
+# With EXP_CHECKOUT_LINK=1, a job's working directory is instead a farm
+# of hard links into the cached tree, which is cheaper still, but shares
+# the files between the jobs: the cached files are made read-only, so
+# jobs can't modify them in place (they are still free to create files),
+# but a job running as root, or one that makes them writable again,
+# would modify the checkout of every job at that commit. So the size and
+# modification time of every cached file is recorded when it is
+# extracted (in the manifest), and an entry whose files don't match is
+# extracted again rather than used.
+#
+# Least recently used entries are evicted once the cache grows beyond
+# MAX_CACHE_SIZE megabytes, which can be overridden with the
+# EXP_CHECKOUT_CACHE_SIZE environment variable.
+
+MAX_CACHE_SIZE = 4096
+
+TREE_DIR = 'tree'
+SIZE_FILE = 'size'
+MANIFEST_FILE = 'manifest'
+
+class stale_entry(Exception):
+    """A cached tree has been modified since it was extracted"""
+    pass
+
+def link_enabled():
+    return os.environ.get('EXP_CHECKOUT_LINK', '') not in ('', '0')
+
+def cache_size_limit():
+    try:
+        return util.parse_size(os.environ['EXP_CHECKOUT_CACHE_SIZE'])
+    except (KeyError, ValueError):
+        return MAX_CACHE_SIZE
+
+def _entry_key(commit, subdir):
+    if subdir in ('.', '', None):
+        return commit
+    return commit + '-' + util.sha1(subdir)[:8]
+
+def _manifest(tree):
+    """The size, modification time and mode of each file in tree, by
+    path"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(tree):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files[os.path.relpath(path, tree)] = \
+                    [st.st_size, st.st_mtime, stat.S_IMODE(st.st_mode)]
+    return files
+
+def _extract(rootdir, commit, subdir):
+    """Return the cache entry for commit, extracting it if necessary"""
+    cachedir = os.path.join(rootdir, exp_common.CHECKOUT_DIR)
+    entry = os.path.join(cachedir, _entry_key(commit, subdir))
+
+    if os.path.isdir(os.path.join(entry, TREE_DIR)):
+        # mark as recently used
+        os.utime(entry, None)
+        return entry
+
+    # extract next to the entry and rename it into place, so that other
+    # processes never see a partially extracted tree
+    tmp_entry = '{}.{}.tmp'.format(entry, os.getpid())
+    if os.path.isdir(tmp_entry):
+        shutil.rmtree(tmp_entry)
+    os.makedirs(os.path.join(tmp_entry, TREE_DIR))
+
+    q = pipes.quote
+    sts = util.exec_shell('cd {} && git archive {} {} | tar xC {}'
+                          .format(q(rootdir), q(commit), q(subdir),
+                                  q(os.path.join(tmp_entry, TREE_DIR))))
+    if sts != 0:
+        shutil.rmtree(tmp_entry)
+        return None
+
+    manifest = _manifest(os.path.join(tmp_entry, TREE_DIR))
+    with open(os.path.join(tmp_entry, MANIFEST_FILE), 'w') as f:
+        # paths are bytes, whatever their encoding
+        json.dump(manifest, f, encoding='latin-1')
+    with open(os.path.join(tmp_entry, SIZE_FILE), 'w') as f:
+        f.write('{}\n'.format(sum(size for size, mtime, mode in manifest.itervalues())))
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        # someone else extracted the same commit at the same time
+        shutil.rmtree(tmp_entry)
+    return entry
+
+def _copy_tree(src, dest, manifest, link=False):
+    """Recreate the tree at src in dest, copying the files or, if link,
+    hard linking them. Raises stale_entry if the files don't match the
+    manifest."""
+    seen = 0
+    for dirpath, dirnames, filenames in os.walk(src):
+        destdir = os.path.join(dest, os.path.relpath(dirpath, src))
+        if not os.path.isdir(destdir):
+            os.mkdir(destdir)
+        for name in dirnames + filenames:
+            srcpath = os.path.join(dirpath, name)
+            destpath = os.path.join(destdir, name)
+            if os.path.islink(srcpath):
+                os.symlink(os.readlink(srcpath), destpath)
+            elif name in filenames:
+                st = os.lstat(srcpath)
+                expected = manifest.get(os.path.relpath(srcpath, src))
+                if expected is None or [st.st_size, st.st_mtime] != expected[:2]:
+                    raise stale_entry(srcpath)
+                seen += 1
+                if link:
+                    if st.st_mode & 0222:
+                        os.chmod(srcpath, stat.S_IMODE(st.st_mode) & ~0222)
+                    try:
+                        os.link(srcpath, destpath)
+                        continue
+                    except OSError as e:
+                        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                            raise
+                        # the filesystem won't link; fall back to copying
+                shutil.copy2(srcpath, destpath)
+                os.chmod(destpath, expected[2])
+    if seen != len(manifest):
+        raise stale_entry(src)
+
+def _read_manifest(entry):
+    try:
+        with open(os.path.join(entry, MANIFEST_FILE)) as f:
+            return dict((path.encode('latin-1'), value)
+                        for path, value in json.load(f).iteritems())
+    except (IOError, ValueError):
+        # left by an older version, or evicted
+        raise stale_entry(entry)
+
+def _discard(entry):
+    """Remove a cache entry; jobs already linked to it keep their files"""
+    discarded = '{}.{}.evict'.format(entry, os.getpid())
+    try:
+        os.rename(entry, discarded)
+    except OSError:
+        return False
+    shutil.rmtree(discarded, ignore_errors=True)
+    return True
+
+def _evict(rootdir, keep):
+    """Remove least recently used entries until the cache is within its
+    size limit"""
+    cachedir = os.path.join(rootdir, exp_common.CHECKOUT_DIR)
+    limit = cache_size_limit() * 1024 * 1024
+
+    entries = []
+    for key in os.listdir(cachedir):
+        entry = os.path.join(cachedir, key)
+        try:
+            with open(os.path.join(entry, SIZE_FILE)) as f:
+                size = int(f.read())
+            entries.append((os.stat(entry).st_mtime, size, entry))
+        except (IOError, OSError, ValueError):
+            # incomplete or being extracted
+            continue
+
+    total = sum(size for mtime, size, entry in entries)
+    for mtime, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        if entry == keep:
+            continue
+        if _discard(entry):
+            total -= size
+
+def checkout(rootdir, commit, subdir, dest):
+    """Materialize the tree of commit (only subdir, if not '.') in the
+    existing directory dest. Returns False if the commit could not be
+    checked out."""
+    for attempt in range(2):
+        entry = _extract(rootdir, commit, subdir)
+        if entry is None:
+            return False
+        try:
+            _copy_tree(os.path.join(entry, TREE_DIR), dest,
+                       _read_manifest(entry), link_enabled())
+        except stale_entry:
+            # a job has modified the cached files; extract them again
+            _discard(entry)
+            shutil.rmtree(dest, ignore_errors=True)
+            os.mkdir(dest)
+            continue
+        except (IOError, OSError):
+            # the entry was evicted while we were copying; start over
+            shutil.rmtree(dest, ignore_errors=True)
+            os.mkdir(dest)
+            continue
+        _evict(rootdir, entry)
+        return True
+    return False
@@ -3,55 +3,167 @@ import time
 import shutil
 import re
 
-import util, exp_common
+import util, exp_common, exp_index, checkout_cache, serialize, job_wrapper, dedup, timeline
 import special_macros
 # TODO: distinguish different failure modes
 [RUN_STATE_VIRGIN, RUN_STATE_RUNNING, RUN_STATE_SUCCESS, RUN_STATE_FAIL] = range(4) 
 
-# TODO: make this a command-line option
-MAX_PROCESSES = 2
+# What a job gets when it doesn't ask for anything in particular. Memory
+# is in megabytes; 0 means no particular amount.
+DEFAULT_RESOURCES = {'cores': 1, 'memory': 0, 'exclusive': False}
+
+# How often to check on running jobs when the backend can't tell us when
+# one of them has finished
+POLL_INTERVAL = 1
+
+# The least number of nodes to have waiting to run when nodes are
+# generated lazily
+MIN_LOOKAHEAD = 8
 
 
 def save_descr(path, info):
     """Save info about an experiment to a file
 
-    info is intended to be a dictionary of objects for which repr does the
-    right thing"""
+    See serialize for the format"""
+
+    save_descrs([(path, info)])
 
-    with open(path, 'w') as f:
-        f.write(repr(info))
-        f.write('\n')
+def save_descrs(descrs):
+    """Save a batch of (path, info) pairs, as save_descr. Each file is
+    replaced atomically, and the index is updated with a single write."""
+    for path, info in descrs:
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(serialize.dumps(info))
+        os.rename(tmp_path, path)
 
-def load_info(hsh):
-    """Load info about an experiment as saved by save_descr"""
+    exp_index.update_many(descrs)
+
+def load_info(hsh, fields=None, rootdir=None):
+    """Load info about an experiment as saved by save_descr. If fields is
+    given, only those fields are read. Files in the old format are
+    converted as they are read."""
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    path = os.path.join(rootdir, exp_common.RESULTS_DIR, hsh,
+                        exp_common.DESCR_FILE)
     try:
-        f = open(os.path.join(util.abs_root_path(), 
-                              exp_common.RESULTS_DIR, hsh, exp_common.DESCR_FILE))
-    except IOError as e:
+        with open(path) as f:
+            s = f.read()
+        info = serialize.loads(s, fields)
+    except (IOError, ValueError, SyntaxError):
         return None
-    else:
-        return eval(f.read())
+
+    if fields is None and not serialize.is_current(s):
+        # replaced atomically, as in save_descrs
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(serialize.dumps(info))
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return info
 
 # Helper Functions for filling in commands.
 
 class dag:
 
-    def __init__(self, toplevel_nodes, backend=None):
+    def __init__(self, toplevel_nodes, backend=None, budget=None, pending=None):
+
+        self.backend = backend
+
+        # the directory jobs run in, relative to the root of the repository.
+        # Taken now, as nodes are also created later on, when running jobs
+        # may have changed the current directory (see add_pending).
+        self.working_dir = os.path.relpath(os.getcwd(), util.abs_root_path())
+
+        # the cores and memory (in megabytes) available to run jobs in;
+        # a memory budget of 0 means memory is not accounted for
+        if budget is None:
+            budget = util.resource_budget()
+        self.budget = budget
+
+        # nodes still to be added to the dag, generated on demand (see
+        # add_pending). Nodes must come after their parents.
+        self.pending = iter(pending) if pending is not None else None
+
+        # experiments are deduplicated as they succeed, if asked for, in
+        # the background (see dedup.deferred)
+        self.dedup = dedup.deferred() if dedup.enabled() else None
+
+        # when set to a list, what timeline needs to know about each job
+        # is collected in it as the job leaves the dag (see prune)
+        self.timeline = None
 
-        self.backend = None
-        
         # sort nodes topologically into dag_nodes
         self.dag_nodes_reversed = []
         for n in toplevel_nodes:
             self.visit(n)
-        self.dag_nodes = list(reversed(self.dag_nodes_reversed))
-	for n in self.dag_nodes:
+        sorted_nodes = list(reversed(self.dag_nodes_reversed))
+        self.dag_nodes = []
+	for n in sorted_nodes:
             n.visited = False
-            
-            self.propagate_params(n)
-            n.job_init()
-            if n['run_state'] == RUN_STATE_SUCCESS:
-                print "Job '%s' has already completed successfully, skipping..." % (n['description'])
+            self.add_node(n)
+
+        self.add_pending()
+
+    def add_node(self, n):
+        """Add a node whose parents have already been added"""
+        self.propagate_params(n)
+        n.job_init(self.working_dir)
+        if n['run_state'] == RUN_STATE_SUCCESS:
+            print "Job '%s' has already completed successfully, skipping..." % (n['description'])
+        else:
+            self.dag_nodes.append(n)
+
+    def add_pending(self):
+        """Take nodes from pending until there are enough runnable ones to
+        keep the budget busy. This way a large parameter sweep starts
+        running right away, and only the nodes near the running frontier
+        are ever in memory. Nodes still waiting on their parents are
+        counted separately, so that independent work further on isn't held
+        up behind a few of them, but no more than the lookahead of them are
+        taken either (their parents may never succeed)."""
+        if self.pending is None:
+            return
+        lookahead = max(2 * self.budget['cores'], MIN_LOOKAHEAD)
+        runnable = 0
+        waiting = 0
+        for n in self.dag_nodes:
+            if n.is_runnable():
+                runnable += 1
+            elif n.info['run_state'] == RUN_STATE_VIRGIN:
+                waiting += 1
+        while runnable < lookahead and waiting < lookahead:
+            try:
+                n = next(self.pending)
+            except StopIteration:
+                self.pending = None
+                return
+            self.add_node(n)
+            if n.is_runnable():
+                runnable += 1
+            elif n.info['run_state'] == RUN_STATE_VIRGIN:
+                waiting += 1
+
+    def prune(self):
+        """Forget about nodes that have finished successfully; their
+        children still know about them"""
+        keep = [n for n in self.dag_nodes
+                if n.dirty or n.info['run_state'] != RUN_STATE_SUCCESS]
+        if len(keep) < len(self.dag_nodes):
+            kept = set(keep)
+            gone = [n for n in self.dag_nodes if n not in kept]
+            if self.timeline is not None:
+                self.timeline.extend(timeline.job(n) for n in gone
+                                     if 'timing' in n.info)
+            # children are only needed to sort the initial nodes; a node
+            # holding on to them would keep everything after it alive
+            for n in gone:
+                n.children = set()
+        self.dag_nodes = keep
 
 
     # helper method for topological sort
@@ -64,26 +176,153 @@ class dag:
 
     def mainloop(self):
          while self.finished_running() == RUN_STATE_RUNNING:
+             self.add_pending()
              self.run_runnable_jobs()
-             time.sleep(1)
+             self.flush()
+             self.wait_for_jobs()
              self.update_states()
+             self.flush()
+             self.prune()
+         if self.dedup is not None:
+             self.dedup.finish()
+         if self.timeline is not None:
+             # the jobs that failed, or never got to run
+             self.timeline.extend(timeline.job(n) for n in self.dag_nodes
+                                  if 'timing' in n.info)
          return self.finished_running()
 
+    def flush(self):
+        """Save the info of every node whose state has changed since it was
+        last saved"""
+        dirty = [n for n in self.dag_nodes if n.dirty]
+        if not dirty:
+            return
+        save_descrs([(os.path.join(n.exp_results, exp_common.DESCR_FILE), n.info)
+                     for n in dirty])
+        for n in dirty:
+            n.dirty = False
+
+    def wait_for_jobs(self):
+        """Block until some running job may have changed state. Backends
+        that are notified when jobs exit provide wait(nodes, timeout), which
+        returns as soon as one of nodes has finished (or after at most
+        timeout seconds); other backends are polled every POLL_INTERVAL."""
+        running = [n for n in self.dag_nodes
+                   if n.info['run_state'] == RUN_STATE_RUNNING]
+        if not running:
+            if not any(n.is_runnable() for n in self.dag_nodes):
+                # nothing to wait on, and nothing could be started
+                time.sleep(POLL_INTERVAL)
+            return
+
+        if hasattr(self.backend, 'wait'):
+            self.backend.wait(running, POLL_INTERVAL)
+        else:
+            time.sleep(POLL_INTERVAL)
+
     def update_states(self):
+        # backends that can find out about all their jobs at once (e.g. with
+        # a single qstat) provide refresh(nodes), called once per tick
+        # before get_state is asked about each node
+        if hasattr(self.backend, 'refresh'):
+            running = [n for n in self.dag_nodes
+                       if n.info['run_state'] == RUN_STATE_RUNNING]
+            if running:
+                self.backend.refresh(running)
+
         for node in self.dag_nodes:
             if node.info['run_state'] == RUN_STATE_RUNNING:
-                node.info['run_state'], node.info['return_code'] = self.backend.get_state(node)
-                if node.info['run_state'] == RUN_STATE_SUCCESS:
+                state, return_code = self.backend.get_state(node)
+                if state != RUN_STATE_RUNNING:
+                    node.mark('finished')
+                    status = job_wrapper.read_status(node.exp_results)
+                    if status is not None:
+                        node.mark('started', status['start'])
+                        node.mark('ended', status['end'])
+                        if 'usage' in status:
+                            node.info['usage'] = status['usage']
+                    node.set_state(state, return_code)
+                if state == RUN_STATE_SUCCESS:
                     node.clean_up_run()
+                    node.mark('cleaned')
+                    if self.dedup is not None:
+                        self.dedup.add(node.hsh)
                 
     def run_runnable_jobs(self):
-        running = 0
+        """Start as many runnable jobs as fit in the budget. Jobs are
+        considered in the order they became runnable, and a job that doesn't
+        fit doesn't stop smaller jobs behind it from being started, but only
+        for one tick: after that, nothing more is started until the oldest
+        such job fits, so that a stream of small jobs can't keep a large (or
+        exclusive) one waiting forever."""
+        used_cores = 0
+        used_memory = 0
+        for node in self.dag_nodes:
+            if node.info['run_state'] == RUN_STATE_RUNNING:
+                cores, memory, exclusive = node.request(self.budget)
+                if exclusive:
+                    return
+                used_cores += cores
+                used_memory += memory
+
+        runnable = []
         for node in self.dag_nodes:
-            if node.info["run_state"] == RUN_STATE_RUNNING:
-                running += 1
-            if node.is_runnable() and running < MAX_PROCESSES:
+            if not node.is_runnable():
+                continue
+            if 'runnable' not in node.info.get('timing', ()):
+                node.mark('runnable')
+
+            # macros are evaluated right here, so they don't take up a slot
+            if node.code is not None:
+                node.run(self.backend)
+                continue
+            runnable.append(node)
+
+        # the jobs that have been waiting longest first
+        runnable.sort(key=lambda n: n.info['timing']['runnable'])
+
+        started = []
+        reserved = False
+        first_blocked = True
+        for node in runnable:
+            if reserved:
+                break
+
+            cores, memory, exclusive = node.request(self.budget)
+            if ((exclusive and (used_cores > 0 or used_memory > 0)) or
+                used_cores + cores > self.budget['cores'] or
+                (self.budget['memory'] and used_memory + memory > self.budget['memory'])):
+                # the budget is kept for the oldest job that doesn't fit
+                # from now on if it had to wait last tick too
+                if first_blocked:
+                    reserved = node.blocked
+                    first_blocked = False
+                node.blocked = True
+                continue
+
+            started.append(node)
+            used_cores += cores
+            used_memory += memory
+            if exclusive:
+                break
+
+        self.start(started)
+
+    def start(self, nodes):
+        """Run nodes on the backend. Backends that can submit a batch of
+        jobs at once (e.g. as a job array) provide run_many(nodes), which
+        sets each node's jobid."""
+        if len(nodes) < 2 or not hasattr(self.backend, 'run_many'):
+            for node in nodes:
                 node.run(self.backend)
-                running += 1
+            return
+
+        for node in nodes:
+            node.setup_env()
+            node.mark('launched')
+        self.backend.run_many(nodes)
+        for node in nodes:
+            node.set_state(RUN_STATE_RUNNING)
 
     def finished_running(self):
         for node in self.dag_nodes:
@@ -91,9 +330,10 @@ class dag:
                 return RUN_STATE_RUNNING
             
             else:
-                save_descr(os.path.join(node.exp_results, exp_common.DESCR_FILE), node.info)
                 if node.info['run_state'] == RUN_STATE_FAIL:
                     return RUN_STATE_FAIL
+        if self.pending is not None:
+            return RUN_STATE_RUNNING
         return RUN_STATE_SUCCESS
     
     # Propagate parameters along dag. Thus each experiment has a history of the parameters of its ancestors 
@@ -117,7 +357,7 @@ class dag:
     
 class dag_node:
      
-    def __init__(self, desc=None, params={}, commit=None, command = None, code = None, parents = None, children = None, rerun = False, subdir_only = False, hsh = None):
+    def __init__(self, desc=None, params={}, commit=None, command = None, code = None, parents = None, children = None, rerun = False, subdir_only = False, hsh = None, info = None, resources = None):
 
         if hsh is None and (desc is None or commit is None or (command is None and code is None)):
             print "Error: if not specifying hash, must specify description, commit, and either command or code."
@@ -135,6 +375,8 @@ class dag_node:
         self.params=params
         self.desc=desc   
         self.hsh = hsh
+        # info already loaded by the caller (e.g. from the index)
+        self.info = info
 
         # DAG structure pointers
         self.parents = set()
@@ -148,13 +390,27 @@ class dag_node:
         self.rerun = rerun
         self.subdir_only = subdir_only
 
+        # whether info has changed since it was last saved; see dag.flush
+        self.dirty = False
+
+        # whether the job was runnable but didn't fit in the budget; see
+        # dag.run_runnable_jobs
+        self.blocked = False
+
+        # cores, memory and exclusive use requested by this job
+        self.resources = dict(DEFAULT_RESOURCES)
+        if resources is not None:
+            self.resources.update(resources)
+
         if hsh is not None:
             self.job_init()
 
     # Have to initialize the hash and all separately, after the parents have been filled. This is because the hash 
     # should use the new command after filling in the hashes of parents and the parameters, and so must be done in
     # topological order.
-    def job_init(self):
+    # working_dir is the directory to run in relative to the root of the
+    # repository, by default the current one.
+    def job_init(self, working_dir=None):
     	
 
         # Creating the new command
@@ -163,7 +419,9 @@ class dag_node:
 	#  A bunch of directories we will need later on
         rootdir = util.abs_root_path()
         self.rootdir=rootdir
-        self.working_dir = os.path.relpath(os.getcwd(), rootdir)
+        if working_dir is None:
+            working_dir = os.path.relpath(os.getcwd(), rootdir)
+        self.working_dir = working_dir
 	self.resultsdir = os.path.join(rootdir, exp_common.RESULTS_DIR)
 	
         if self.hsh is None:        
@@ -187,7 +445,7 @@ class dag_node:
                 new_code, deps = exp_common.expand_command(code, self.params, self.parents)   
                 new_code = new_code.replace("<---", "[")
                 self.new_code = new_code.replace("--->", "]")
-                deps=[x.hsh for x in self.parents]
+                deps=sorted(x.hsh for x in self.parents)
                 self.hsh = util.sha1(self.commit + str(len(self.working_dir)) +
                                  self.working_dir + str(len(self.code)) + self.new_code + repr(deps))
                 self.exp_results = os.path.join(self.resultsdir, self.hsh)
@@ -199,7 +457,8 @@ class dag_node:
             self.info = load_info(self.hsh)
             
         else:
-            self.info = load_info(self.hsh)
+            if self.info is None:
+                self.info = load_info(self.hsh)
             if self.info is None:
                 print "Error: could not load experiment %s." % (self.hsh)
                 exit(1)
@@ -208,6 +467,7 @@ class dag_node:
             self.deps = self.info['deps'] 
             #exp_common.expand_command(self.info["command"], self.info["params"], self.deps())   
             self.desc = self.info['description']
+            self.resources.update(self.info.get('resources', {}))
             self.exp_results = os.path.join(self.resultsdir, self.hsh)
             self.expdir = os.path.join(rootdir, exp_common.EXP_DIR, self.hsh)
 
@@ -228,6 +488,7 @@ class dag_node:
 
             self.info['commit'] = self.commit # commit hash (string)
             self.info['date'] = time.time()
+            self.info['timing'] = {'created': self.info['date']}
             self.info['params'] = self.params # parameters to pass (dictionary)
 
             self.info['run_state'] = RUN_STATE_VIRGIN
@@ -235,6 +496,7 @@ class dag_node:
             
             self.info['final_command']=self.new_cmd
             self.info['final_code']=self.new_code
+            self.info['resources'] = self.resources
         else:
             if self.info['description'] != self.desc:
                 print "Warning: job description '%s' differs from " \
@@ -247,6 +509,9 @@ class dag_node:
                 self.info['run_state'] = RUN_STATE_VIRGIN
                 self.info['return_code'] = None
                 self.info['date'] = time.time()
+                self.info['timing'] = {'created': self.info['date']}
+                self.info.pop('usage', None)
+                self.info['resources'] = self.resources
                 shutil.rmtree(self.exp_results)
 
 
@@ -267,11 +532,22 @@ class dag_node:
             child.parents.add(self)
             #child.info['deps'] += set([self.hsh,])
 
+    def request(self, budget):
+        """The (cores, memory, exclusive) this job takes out of budget. A job
+        asking for more than the whole budget gets the whole budget, so that
+        it can still run (on its own)."""
+        cores = min(self.resources['cores'], budget['cores'])
+        memory = self.resources['memory']
+        if budget['memory']:
+            memory = min(memory, budget['memory'])
+        return cores, memory, self.resources['exclusive']
+
     def is_runnable(self):
         parents_succeeded = all([p.info['run_state'] == RUN_STATE_SUCCESS for p in self.parents])
         return self.info['run_state'] == RUN_STATE_VIRGIN and parents_succeeded
 
     def setup_env(self):
+        self.mark('setup')
 
 	# Create experiments directory if it doesn't exist
 	if not os.path.isdir(os.path.join(self.rootdir, exp_common.EXP_DIR)):
@@ -280,9 +556,14 @@ class dag_node:
 	# Make the results directory for this experiment
         if not os.path.isdir(self.exp_results):
             os.makedirs(self.exp_results)
+        # backends find out how the job ended from its status file
+        # (see job_wrapper); don't let them see one from an earlier run
+        status_file = os.path.join(self.exp_results, job_wrapper.STATUS_FILE)
+        if os.path.exists(status_file):
+            os.remove(status_file)
 	
-	# Save the description and info
-	save_descr(os.path.join(self.exp_results, exp_common.DESCR_FILE), self.info);
+	# The description and info are saved once the job has started (see
+	# dag.flush)
 
 	# Make the experiment directories and checkout code. Do it
 	# here so that you fail in the root node of the cluster, if
@@ -298,38 +579,52 @@ class dag_node:
 
 
         if self.subdir_only:
-            checkout_dir = working_dir
+            checkout_dir = self.working_dir
         else:
             checkout_dir = '.'
         
-        # checkout the appropriate commit
-        # can do this with git --work-tree=... checkout commit -- ., but
-        # cannot do concurrently, so use git archive...
-
-        # ... whose behavior seems to depend on current directory
+        # checkout the appropriate commit. Each commit is only extracted
+        # once (with git archive, which unlike git checkout can be run
+        # concurrently), and then linked into each experiment directory;
+        # see checkout_cache.
         rootdir=util.abs_root_path()
         os.chdir(rootdir)
-        sts = util.exec_shell('git archive {} {} | tar xC {}'
-                         .format(self.info['commit'], checkout_dir, self.expdir))
-        if sts != 0:
+        if not checkout_cache.checkout(rootdir, self.info['commit'],
+                                       checkout_dir, self.expdir):
             print 'Attempt to checkout experimental code failed'
             exit(1)
 
     def run(self, black_box):
 
         self.setup_env()
+        self.mark('launched')
 
         if self.info['code'] is not None:
             try:
                 print 'Running code'
-                self.info['return_code'] = special_macros.evaluate(self.new_code, self)
-                self.info['run_state'] = RUN_STATE_SUCCESS
+                return_code = special_macros.evaluate(self.new_code, self)
+                self.mark('finished')
+                self.set_state(RUN_STATE_SUCCESS, return_code)
             except Exception as e:
                 print e
-                self.info['run_state'] = RUN_STATE_FAIL
+                self.mark('finished')
+                self.set_state(RUN_STATE_FAIL)
         else:
             self.jobid = black_box.run(self)
-            self.info['run_state'] = RUN_STATE_RUNNING
+            self.set_state(RUN_STATE_RUNNING)
+
+    def mark(self, phase, when=None):
+        """Record when the job reached a phase of its life (see timeline).
+        Saved with the next change of state."""
+        if when is None:
+            when = time.time()
+        self.info.setdefault('timing', {})[phase] = when
+
+    def set_state(self, state, return_code=None):
+        """Change the run state, marking the info to be saved"""
+        self.info['run_state'] = state
+        self.info['return_code'] = return_code
+        self.dirty = True
 
     def clean_up_run(self):
         # Need to cd back out of expdir
@@ -372,10 +667,7 @@ class dag_node:
     def param(self, name):
         return self.info['params'][name]
 
-    def broken_deps(self, in_dep=False):
-        if in_dep and not self.success():
-            return True
-        try:
-            return any(dag_node(hsh = hsh).broken_deps(in_dep=True) for hsh in self.info['deps'])
-        except IOError:
-            return True
+    def broken_deps(self):
+        """Whether any transitive dependency is missing or did not succeed.
+        Answered from the store-wide cache in exp_index."""
+        return exp_index.has_broken_deps(self.hsh, self.info['deps'])
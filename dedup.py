@@ -0,0 +1,322 @@
+import os
+import json
+import errno
+import fcntl
+import hashlib
+import stat
+import threading
+import Queue
+
+import util, exp_common, job_wrapper
+
+# dedup.py: deduplication of result files.
+#
+# Experiments often write byte-identical files (copies of datasets,
+# identical models from reruns, ...). dedup() hashes the files in the
+# results directories and keeps one copy of each distinct file in a
+# content-addressed store, .exp/blobs/<first two digits>/<sha1>, replacing
+# every copy with a hard link to it. Linked files are made read-only, so
+# that writing to one of them can't change all the others; results are
+# not supposed to change once an experiment has finished anyway.
+#
+# The digest of every file seen is kept in an index, together with the
+# size, modification time and inode it had, so later passes only hash
+# files that are new or have changed. Blobs no longer linked from any
+# experiment (e.g. after purge) are removed by a full pass. Passes append
+# to the index, or rewrite it, holding a lock on .exp/blobs/index.lock (see
+# index_lock); a pass that rewrites it holds the lock from the time it
+# reads it, so that nothing appended in between is lost.
+#
+# Files smaller than EXP_DEDUP_MIN_SIZE (default MIN_SIZE bytes), and the
+# files exp itself keeps in each results directory, are left alone. If
+# EXP_DEDUP is set, each experiment is deduplicated as soon as it
+# succeeds (see dag.update_states), in a background thread so that
+# hashing large outputs doesn't hold up the scheduler (see deferred).
+
+MIN_SIZE = 4096
+
+INDEX = 'index'
+LOCK = 'index.lock'
+
+def blob_dir(rootdir=None):
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    return os.path.join(rootdir, exp_common.BLOB_DIR)
+
+def enabled():
+    return os.environ.get('EXP_DEDUP', '') not in ('', '0')
+
+def min_size():
+    try:
+        return int(os.environ['EXP_DEDUP_MIN_SIZE'])
+    except (KeyError, ValueError):
+        return MIN_SIZE
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1 << 20)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def load_index(rootdir=None):
+    """Map from file paths (relative to the results directory) to the
+    (size, mtime, inode, digest) they had when last looked at"""
+    index = {}
+    try:
+        with open(os.path.join(blob_dir(rootdir), INDEX)) as f:
+            for line in f:
+                try:
+                    path, size, mtime, ino, digest = json.loads(line)
+                except ValueError:
+                    # torn last line
+                    continue
+                index[path.encode('utf-8')] = (size, mtime, ino, digest.encode('utf-8'))
+    except IOError:
+        pass
+    return index
+
+class index_lock:
+    """An exclusive lock on the index, between processes and threads"""
+
+    def __init__(self, rootdir=None):
+        self.path = os.path.join(blob_dir(rootdir), LOCK)
+        self.f = None
+
+    def acquire(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        # closing the file releases the lock
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def _index_line(key, entry):
+    return json.dumps([key] + list(entry)) + '\n'
+
+def save_index(index, rootdir=None):
+    path = os.path.join(blob_dir(rootdir), INDEX)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        for key, entry in index.iteritems():
+            f.write(_index_line(key, entry))
+    os.rename(tmp_path, path)
+
+class stats:
+    def __init__(self):
+        self.files = 0
+        self.hashed = 0
+        self.linked = 0
+        self.saved = 0
+        self.removed = 0
+        # digests that would have been stored, in a dry run
+        self.stored = set()
+
+def dedup_file(path, key, index, blobs, result, dry_run=False):
+    """Replace the file at path with a link to the blob with its contents,
+    storing it as the blob if there is none yet. key is its name in the
+    index, which is updated."""
+    st = os.lstat(path)
+    if not stat.S_ISREG(st.st_mode) or st.st_size < min_size():
+        return
+    result.files += 1
+
+    entry = index.get(key)
+    if entry is not None and entry[:3] == (st.st_size, st.st_mtime, st.st_ino):
+        digest = entry[3]
+    else:
+        digest = file_digest(path)
+        result.hashed += 1
+
+    blob = os.path.join(blobs, digest[:2], digest)
+    try:
+        blob_st = os.stat(blob)
+    except OSError:
+        blob_st = None
+
+    if blob_st is None and dry_run:
+        if digest in result.stored:
+            result.linked += 1
+            result.saved += st.st_size
+        result.stored.add(digest)
+    elif blob_st is None:
+        # the first copy becomes the blob
+        if not os.path.isdir(os.path.dirname(blob)):
+            os.makedirs(os.path.dirname(blob))
+        try:
+            os.link(path, blob)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # someone else stored the same contents just now
+            blob_st = os.stat(blob)
+        else:
+            # only once it is the blob, so that a file that can't be
+            # stored keeps its mode
+            os.chmod(path, stat.S_IMODE(st.st_mode) & ~0222)
+
+    if blob_st is not None and blob_st.st_ino != st.st_ino:
+        if blob_st.st_size != st.st_size:
+            # not the contents the blob should have; leave both alone
+            return
+        if not dry_run:
+            tmp_path = '{}.{}.dedup'.format(path, os.getpid())
+            try:
+                os.link(blob, tmp_path)
+            except OSError as e:
+                if e.errno in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    # can't link here; keep the copy
+                    return
+                raise
+            os.rename(tmp_path, path)
+        result.linked += 1
+        result.saved += st.st_size
+
+    if not dry_run:
+        st = os.lstat(path)
+    index[key] = (st.st_size, st.st_mtime, st.st_ino, digest)
+
+def _experiment_files(results):
+    for dirpath, dirnames, filenames in os.walk(results):
+        for name in filenames:
+            relpath = os.path.relpath(os.path.join(dirpath, name), results)
+            # files managed by exp, which are rewritten in place
+            if (relpath in (exp_common.DESCR_FILE, job_wrapper.STATUS_FILE) or
+                name.endswith('.tmp')):
+                continue
+            yield relpath
+
+def dedup_experiment(hsh, index=None, result=None, dry_run=False, rootdir=None):
+    """Deduplicate the files of one experiment. Without an index, the
+    saved one is used and appended to."""
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    save = index is None
+    if index is None:
+        index = load_index(rootdir)
+    if result is None:
+        result = stats()
+    blobs = blob_dir(rootdir)
+    if not dry_run and not os.path.isdir(blobs):
+        os.makedirs(blobs)
+
+    results = os.path.join(rootdir, exp_common.RESULTS_DIR, hsh)
+    changed = []
+    for relpath in _experiment_files(results):
+        key = os.path.join(hsh, relpath)
+        old = index.get(key)
+        try:
+            dedup_file(os.path.join(results, relpath), key, index, blobs,
+                       result, dry_run)
+        except (IOError, OSError) as e:
+            print 'Could not deduplicate {}: {}'.format(key, e)
+            continue
+        if index.get(key) != old:
+            changed.append(key)
+
+    if save and not dry_run and changed:
+        with index_lock(rootdir):
+            with open(os.path.join(blobs, INDEX), 'a') as f:
+                f.write(''.join(_index_line(k, index[k]) for k in changed))
+    return result
+
+class deferred:
+    """Deduplicates experiments one after the other in a background
+    thread. finish() waits for those added so far."""
+
+    def __init__(self, rootdir=None):
+        if rootdir is None:
+            rootdir = util.abs_root_path()
+        self.rootdir = rootdir
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def add(self, hsh):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.work)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(hsh)
+
+    def work(self):
+        while True:
+            hsh = self.queue.get()
+            if hsh is None:
+                return
+            try:
+                dedup_experiment(hsh, rootdir=self.rootdir)
+            except Exception as e:
+                print 'Could not deduplicate {}: {}'.format(hsh, e)
+
+    def finish(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+def collect_garbage(rootdir=None):
+    """Remove blobs that are no longer linked from any experiment. Returns
+    how many were removed."""
+    removed = 0
+    blobs = blob_dir(rootdir)
+    for prefix in os.listdir(blobs):
+        d = os.path.join(blobs, prefix)
+        if not os.path.isdir(d):
+            continue
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            if os.lstat(path).st_nlink == 1:
+                os.remove(path)
+                removed += 1
+    return removed
+
+def dedup(hashes=None, dry_run=False, rootdir=None):
+    """Deduplicate the given experiments (default: all of them). A pass
+    over all experiments also compacts the index and removes unused
+    blobs."""
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    full = hashes is None
+    if full:
+        try:
+            hashes = os.listdir(os.path.join(rootdir, exp_common.RESULTS_DIR))
+        except OSError:
+            hashes = []
+
+    # the index is rewritten at the end, so nobody may append to it from
+    # the time it is read
+    lock = None
+    if not dry_run:
+        if not os.path.isdir(blob_dir(rootdir)):
+            os.makedirs(blob_dir(rootdir))
+        lock = index_lock(rootdir)
+        lock.acquire()
+    try:
+        index = load_index(rootdir)
+        result = stats()
+        for hsh in hashes:
+            dedup_experiment(hsh, index, result, dry_run, rootdir)
+
+        if not dry_run:
+            if full:
+                # forget files that are gone
+                resultsdir = os.path.join(rootdir, exp_common.RESULTS_DIR)
+                index = dict((k, v) for k, v in index.iteritems()
+                             if os.path.exists(os.path.join(resultsdir, k)))
+                result.removed = collect_garbage(rootdir)
+            save_index(index, rootdir)
+    finally:
+        if lock is not None:
+            lock.release()
+    return result
@@ -10,8 +10,15 @@
 #
 
 
-import subprocess
 import sys
+
+if __name__ == '__main__':
+    # let a running daemon answer, before importing anything else (see
+    # exp_daemon)
+    import exp_daemon
+    exp_daemon.forward(sys.argv[1:])
+
+import subprocess
 import argparse
 import os, os.path
 import shutil
@@ -19,7 +26,9 @@ import hashlib
 import time
 import datetime
 import re
-import dag, util, local_backend
+import heapq
+import signal
+import dag, util, backends, exp_index, job_wrapper, dedup, table, timeline, exp_daemon
 
 from exp_common import *
 
@@ -27,11 +36,16 @@ RESULTS_PATH = 'results'
 EXP_PATH = 'exp'
 DESCR_FILE = 'descr'
 
+# how often tail --follow checks that the experiment is still running, and
+# how long it waits for more output before giving up, in seconds
+FOLLOW_CHECK = 5
+FOLLOW_IDLE = 600
+
 def parse_params(params_str):
     """Parse a parameter in the string in the from 'k1:v1 k2:v2 ...' into
     a dictionary"""
 
-    if args.params is None:
+    if params_str is None:
         return {}
     
     params = {}
@@ -96,34 +110,74 @@ def run_exp(args):
     check_args(args)
 
     # find out the hash of experimental commit
-    hsh = util.exec_output(['git', 'rev-parse', args.commit]).strip()
+    hsh = util.rev_parse(args.commit)
+    if hsh is None:
+        print 'Could not find commit', args.commit
+        exit(1)
 
     # parse parameters from command line
     params = parse_params(args.params)
 
-    job = dag.dag_node(args.description, params, hsh, args.command, rerun = args.rerun, subdir_only = args.subdir_only)
-    jobs = dag.dag([job,])
-    lb = local_backend.local_backend()
-    jobs.backend = lb
+    resources = {'exclusive': args.exclusive}
+    if args.cores is not None:
+        resources['cores'] = args.cores
+    if args.memory is not None:
+        resources['memory'] = util.parse_size(args.memory)
+
+    job = dag.dag_node(args.description, params, hsh, args.command, rerun = args.rerun, subdir_only = args.subdir_only, resources = resources)
+    backend = backends.make_backend(args.backend)
+    jobs = dag.dag([job,], backend, backends.resource_budget(backend, args.max_cores, args.max_memory))
+    if args.trace is not None:
+        jobs.timeline = []
     jobs.mainloop()
+    if args.trace is not None:
+        timeline.write_trace(args.trace, jobs.timeline, jobs.budget['cores'])
+
+
+def parse_date(s):
+    """Parse a date given either as an age ('30m', '12h', '3d', '2w') or
+    as 'YYYY-MM-DD [HH:MM]' into seconds since the epoch"""
+    units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+             'w': 7 * 24 * 60 * 60}
+    s = s.strip()
+    if s and s[-1] in units:
+        try:
+            return time.time() - float(s[:-1]) * units[s[-1]]
+        except ValueError:
+            pass
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('could not understand date {}'.format(s))
+
+def group_descrs(exps, limit=None):
+    """Group experiments by description, in one pass. Groups are generated
+    most recently run first, each sorted most recent first; only the
+    groups actually consumed are sorted."""
+    groups = {}
+    for e in exps:
+        groups.setdefault(e['description'], []).append(e)
+
+    # order groups by their latest experiment
+    latest = [(max(e['date'] for e in group), descr)
+              for descr, group in groups.iteritems()]
+    if limit is not None:
+        latest = heapq.nlargest(limit, latest)
+    else:
+        latest.sort(reverse=True)
 
+    for date, descr in latest:
+        group = groups[descr]
+        group.sort(key=lambda e: e['date'], reverse=True)
+        yield group
 
-# modifies exps in place!
-def list_descrs(exps):
-
-    # sort and group experiments
-    exps.sort(lambda x, y: cmp(y['date'], x['date']))
-    
-    exp_groups = []
-    while exps:
-        matches = [e for e in exps
-                   if e['description'] == exps[0]['description']]
+def list_descrs(exps, limit=None, since=None):
+    if since is not None:
+        exps = [e for e in exps if e['date'] >= since]
 
-        exp_groups.append(matches)
-        for exp in matches:
-            exps.remove(exp)
-            
-    for exp_group in exp_groups:
+    for exp_group in group_descrs(exps, limit):
 
         print '{:32}  {:4} experiments  last: {}'.format(
                 util.trunc(exp_group[0]['description'], 30),
@@ -136,12 +190,18 @@ def list_descrs(exps):
 
         has_params = filter(lambda e: 'params' in e and e['params'] is not None,
                             exp_group)
-        params = sum([e['params'].keys() for e in has_params], [])
+        params = set()
+        for e in has_params:
+            params.update(e['params'].keys())
 
-        params_dict = dict((k, [e['params'][k] for e in exp_group]) for k in params)
+        params_dict = dict((k, [e['params'][k] for e in has_params
+                                if k in e['params']]) for k in params)
 
         print '  code: {}  params: {}'.format(code, params_dict)
 
+        # show each group as soon as it's ready, even through a pipe
+        sys.stdout.flush()
+
 def purge(args):
     matches = find(args.exp)
     
@@ -149,7 +209,7 @@ def purge(args):
         print 'Multiple matching experiments; use --all to purge them all'
         return
 
-    resultsdir = os.path.join(util.abs_root_path(), RESULTS_PATH)
+    resultsdir = os.path.join(util.abs_root_path(), RESULTS_DIR)
     for exp in matches:
         print 'Purging {} ({})'.format(exp['description'], exp.hsh)
         if not args.dry_run:
@@ -157,6 +217,33 @@ def purge(args):
                 shutil.rmtree(os.path.join(resultsdir, exp.hsh))
             except Exception as e:
                 print 'Could not remove directory: ', e
+            else:
+                exp_index.remove(exp.hsh)
+
+def reindex(args):
+    entries = exp_index.rebuild()
+    print 'Indexed {} experiments'.format(len(entries))
+
+def dedup_exps(args):
+    if args.exp is None:
+        hashes = None
+    else:
+        hashes = [e.hsh for e in find(args.exp, read_descrs(keep_unfinished=True, keep_failed=True,
+                                                            keep_broken_deps=True))]
+        if not hashes:
+            print 'Could not find matching experiment ' + args.exp
+            exit(1)
+
+    result = dedup.dedup(hashes, args.dry_run)
+    saved = result.saved / (1024. * 1024)
+    if args.dry_run:
+        print '{} files, {} hashed; linking {} duplicates would save {:.1f} MB'.format(
+            result.files, result.hashed, result.linked, saved)
+    else:
+        print '{} files, {} hashed, {} duplicates linked, {:.1f} MB saved'.format(
+            result.files, result.hashed, result.linked, saved)
+    if result.removed:
+        print 'Removed {} unused blobs'.format(result.removed)
 
 def print_hashes(args):
     if args.latest:
@@ -180,6 +267,23 @@ def run_command(args):
     cmd = read_command_args(args)
     sys.exit(util.exec_shell(cmd))
     
+# resource usage columns of exp show --usage (see job_wrapper.usage):
+# CPU seconds, maximum resident set size of any process and sampled peak
+# memory of all of them together in megabytes, and megabytes read and
+# written
+USAGE_COLUMNS = ['CPU', 'MaxRSS', 'Peak', 'Read', 'Write']
+
+def usage_strs(usage, columns):
+    if not usage:
+        return [''] * len(columns)
+    values = {'CPU': '{:.1f}'.format(usage['user'] + usage['sys']),
+              'MaxRSS': '{:.0f}'.format(usage['max_rss'] / 1024.),
+              'Peak': '{:.0f}'.format(usage['peak_rss'] / 1024.) if 'peak_rss' in usage else '',
+              # blocks of 512 bytes
+              'Read': '{:.1f}'.format(usage['inblock'] / 2048.),
+              'Write': '{:.1f}'.format(usage['oublock'] / 2048.)}
+    return [values[c] for c in columns]
+
 def show_exp(args):
     # maybe should actually find one particular description,
     #  then get all the experiments of that description
@@ -226,9 +330,21 @@ def show_exp(args):
         deps_format = '{}'
         deps_header = ''
 
+    # usage is only in the descr files (see exp_record), so it is only
+    # read, once for each experiment, when asked for
+    usages = {}
+    usage_columns = []
+    if args.usage:
+        usages = dict((exp.hsh, exp.get('usage')) for exp in matches)
+        usage_columns = list(USAGE_COLUMNS)
+        if not any('peak_rss' in (usage or {}) for usage in usages.itervalues()):
+            usage_columns.remove('Peak')
+
     # relying now on chronological sort from find
-    format_str = '{:1}{:8} {:25} {:9} {:8} {:3} ' + deps_format + ' {:>8}' * len(params)
-    print format_str.format('', 'Hash', 'Start Date', 'Duration', 'Code', 'Cmd', deps_header, *params)
+    format_str = ('{:1}{:8} {:25} {:9} {:8} {:3} ' + deps_format +
+                  ' {:>8}' * (len(usage_columns) + len(params)))
+    print format_str.format('', 'Hash', 'Start Date', 'Duration', 'Code', 'Cmd', deps_header,
+                            *(usage_columns + params))
     for exp in matches:
         if exp.running():
             status = '*'
@@ -255,9 +371,89 @@ def show_exp(args):
                     exp['commit'][:6],
                     command_tab[exp['command']],
                     ','.join(dep[:6] for dep in exp['deps']),
-                    *(exp['params'][p] for p in params)))
+                    *(usage_strs(usages.get(exp.hsh), usage_columns) +
+                      [exp['params'][p] for p in params])))
 
-if __name__ == '__main__':
+def tail_exp(args):
+    matches = find(args.exp, read_descrs(keep_unfinished=True, keep_failed=True,
+                                         keep_broken_deps=True))
+    if len(matches) == 0:
+        print 'Could not find matching experiment ' + args.exp
+        exit(1)
+
+    # the latest matching experiment
+    results = os.path.join(util.abs_root_path(), RESULTS_DIR, matches[0].hsh)
+    path = os.path.join(results, job_wrapper.ERR_FILE if args.err else job_wrapper.LOG_FILE)
+    try:
+        sys.stdout.write(''.join(job_wrapper.tail(path, args.lines)))
+    except IOError as e:
+        print 'Could not read {}: {}'.format(path, e.strerror)
+        exit(1)
+    if not args.follow:
+        return
+
+    # keep printing what is written until the job has exited. A job that
+    # was killed (or an experiment run before exit statuses were recorded)
+    # leaves no status file, so also stop once the scheduler no longer
+    # has it running, or once there has been no output for FOLLOW_IDLE
+    f = open(path, 'rb')
+    f.seek(0, os.SEEK_END)
+    done = False
+    stopped = None
+    checked = 0
+    last_output = time.time()
+    while True:
+        if not done:
+            done = job_wrapper.read_status(results) is not None
+        if not done and time.time() - checked >= FOLLOW_CHECK:
+            checked = time.time()
+            info = dag.load_info(matches[0].hsh, fields=['run_state'])
+            if info is None or info['run_state'] != dag.RUN_STATE_RUNNING:
+                done = True
+                if job_wrapper.read_status(results) is None:
+                    stopped = ('Experiment {} is not running, and recorded no exit status'
+                               .format(matches[0].hsh[:6]))
+        # seeking clears the end of file flag, which stdio may otherwise
+        # keep returning once it has been reached
+        f.seek(0, os.SEEK_CUR)
+        data = f.read()
+        if data:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+            last_output = time.time()
+        elif done:
+            break
+        elif time.time() - last_output >= FOLLOW_IDLE:
+            stopped = ('No output for {} seconds; experiment {} may still be running'
+                       .format(FOLLOW_IDLE, matches[0].hsh[:6]))
+            break
+        else:
+            time.sleep(0.5)
+            try:
+                rotated = os.path.getsize(path) < f.tell()
+            except OSError:
+                continue
+            if rotated:
+                f.close()
+                f = open(path, 'rb')
+    f.close()
+    if stopped is not None:
+        print stopped
+
+def export_table(args):
+    path, rows, read = table.export(args.description, args.output, args.rebuild)
+    print 'Wrote {} rows ({} read) to {}'.format(rows, read, path)
+
+def run_daemon(args):
+    rootdir = util.abs_root_path()
+    if args.action == 'start':
+        exp_daemon.start(rootdir, args.foreground)
+    elif args.action == 'stop':
+        exp_daemon.stop(rootdir)
+    else:
+        exp_daemon.status(rootdir)
+
+def make_parser():
     parser = argparse.ArgumentParser(description='Track content created by code')
     subparsers = parser.add_subparsers()
 
@@ -271,13 +467,22 @@ if __name__ == '__main__':
     run_parser.add_argument('--params', help='experimental parameter list')
     run_parser.add_argument('--subdir-only', action='store_true', help='only checkout the contents of current directory')
     run_parser.add_argument('--rerun', action='store_true', help='rerun this experiment, deleting existing results if necessary')
+    run_parser.add_argument('--cores', type=int, help='number of cores the experiment uses (default 1)')
+    run_parser.add_argument('--memory', help='memory the experiment uses, e.g. 512M or 2G')
+    run_parser.add_argument('--exclusive', action='store_true', help='do not run anything else alongside the experiment')
+    run_parser.add_argument('--max-cores', type=int, help='cores available for running experiments (default: all the backend has)')
+    run_parser.add_argument('--max-memory', help='memory available for running experiments (default: all)')
+    backends.add_argument(run_parser)
+    run_parser.add_argument('--trace', help='write a Chrome trace of the run to this file')
     run_parser.add_argument('description', help='unique description of this experiment')
     run_parser.add_argument('command', nargs='?', help='command to run')
     run_parser.add_argument('commit', nargs='?', help='git commit expression indicating code to run')
     run_parser.set_defaults(func=run_exp)
 
     list_parser = subparsers.add_parser('list', help='list previous experiments')
-    list_parser.set_defaults(func=lambda args: list_descrs(read_descrs(keep_unreadable=True)))
+    list_parser.add_argument('--limit', type=int, help='only list the N most recently run descriptions')
+    list_parser.add_argument('--since', type=parse_date, help='only list experiments started since a date (YYYY-MM-DD) or age (e.g. 3d, 12h)')
+    list_parser.set_defaults(func=lambda args: list_descrs(read_descrs(keep_unreadable=True), args.limit, args.since))
     
     purge_parser = subparsers.add_parser('purge', help='delete experimental data')
     purge_parser.add_argument('--dry-run', action='store_true')
@@ -285,6 +490,14 @@ if __name__ == '__main__':
     purge_parser.add_argument('exp', help='experiment identifier')
     purge_parser.set_defaults(func=purge)
     
+    reindex_parser = subparsers.add_parser('reindex', help='rebuild the experiment index from the results directory')
+    reindex_parser.set_defaults(func=reindex)
+
+    dedup_parser = subparsers.add_parser('dedup', help='replace identical result files with links to one copy')
+    dedup_parser.add_argument('--dry-run', action='store_true')
+    dedup_parser.add_argument('exp', nargs='?', help='experiment identifier (default: all experiments)')
+    dedup_parser.set_defaults(func=dedup_exps)
+
     hash_parser = subparsers.add_parser('hash', help='print experimental hashes')
     hash_parser.add_argument('--latest', action='store_true', help='include only non-dominated experiments')
     hash_parser.add_argument('exp', help='experiment identifier')
@@ -303,8 +516,36 @@ if __name__ == '__main__':
     print_parser.set_defaults(func=print_command)
 
     show_parser = subparsers.add_parser('show', help='show details of one experiment')
+    show_parser.add_argument('--usage', action='store_true', help='show the CPU time, memory and I/O of each experiment')
     show_parser.add_argument('exp', nargs='*', help='experiment identifier')
     show_parser.set_defaults(func=show_exp)
 
+    tail_parser = subparsers.add_parser('tail', help='show the end of the output of an experiment')
+    tail_parser.add_argument('-n', '--lines', type=int, default=10, help='number of lines to show (default 10)')
+    tail_parser.add_argument('--err', action='store_true', help='show the standard error instead of the standard output')
+    tail_parser.add_argument('-f', '--follow', action='store_true', help='keep showing output until the experiment exits')
+    tail_parser.add_argument('exp', help='experiment identifier')
+    tail_parser.set_defaults(func=tail_exp)
+
+    table_parser = subparsers.add_parser('table', help='export the parameters and outputs of the experiments of a description as a table')
+    table_parser.add_argument('-o', '--output', action='append', default=[], help='output file to read a value from (the first line); may be given more than once')
+    table_parser.add_argument('--rebuild', action='store_true', help='read all experiments again rather than only new ones')
+    table_parser.add_argument('description', help='description of the experiments')
+    table_parser.set_defaults(func=export_table)
+
+    daemon_parser = subparsers.add_parser('daemon', help='run a daemon answering list, show, hash and print from memory')
+    daemon_parser.add_argument('action', choices=['start', 'stop', 'status'])
+    daemon_parser.add_argument('--foreground', action='store_true', help='with start, serve from this process')
+    daemon_parser.set_defaults(func=run_daemon)
+
+    return parser
+
+if __name__ == '__main__':
+    parser = make_parser()
+
+    # exit quietly when our output is piped into something that stops
+    # reading early, like head
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
     args = parser.parse_args()
     args.func(args)
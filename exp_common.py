@@ -1,7 +1,8 @@
 import os
 import time
 import re
-import util, dag
+import bisect
+import util, dag, exp_index
 import sys
 
 DOT_DIR = '.exp'
@@ -10,6 +11,11 @@ RESULTS_DIR = os.path.join(DOT_DIR, 'results')
 DESCR_FILE = 'descr'
 TASK_DIR = os.path.join(DOT_DIR, 'tasks')
 TASK_COMMIT_FILE='commit'
+INDEX_FILE = os.path.join(DOT_DIR, 'index')
+VALIDITY_FILE = os.path.join(DOT_DIR, 'validity')
+CHECKOUT_DIR = os.path.join(DOT_DIR, 'checkouts')
+BLOB_DIR = os.path.join(DOT_DIR, 'blobs')
+TABLE_DIR = os.path.join(DOT_DIR, 'tables')
 
 # A hack. Need to do something so that all experiments aren't repeatedly read from disk.
 all_nodes=None
@@ -116,31 +122,94 @@ def expand_command(cmd, params, parent_nodes = None, have_loaded_all=False):
     return expanded_cmd
 
 
-# This function matches a description with a node. Copied from exp with minor changes
-def match(s, nodes):
-    exact_match = lambda x, d: x.hsh == d
-    prefix_match = lambda x, d: x.hsh.startswith(d)
-    exact_descr_match = lambda x, d: x.info['description'] == d
-    prefix_descr_match = lambda x, d: x.info['description'].startswith(d)
-    def exact_params_match(x, d):
-        if ':' not in d:
-            return False
-        d, ps = d.split(':', 1)
+def _parse_params_id(d):
+    """Split 'descr:p1=v1,p2=v2' into the description and the parameters
+    as a frozenset of (name, float value) pairs, or return None if d
+    doesn't name parameters"""
+    if ':' not in d:
+        return None
+    d, ps = d.split(':', 1)
+    try:
         ps = [p.split('=', 1) for p in ps.split(',')]
         # should have a single parameter special case
-        return (x.info['description'] == d and len(x.info['params']) == len(ps)
-                and all(x.info['params'][p[0]] == float(p[1]) for p in ps))
+        key = frozenset((p[0], float(p[1])) for p in ps)
+    except (IndexError, ValueError):
+        return None
+    if len(key) != len(ps):
+        # the same parameter given twice, which no experiment matches
+        return None
+    return d, key
+
+class exp_matcher:
+    """Lookup structure over a collection of experiments. match gives the
+    same results as searching, in order, for an exact description match
+    with parameters, an exact description match, a description prefix
+    match, an exact hash match and a hash prefix match."""
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self.by_hash = {}
+        self.by_descr = {}
+        self.by_params = {}
+
+        for i, x in enumerate(self.nodes):
+            self.by_hash.setdefault(x.hsh, []).append(i)
+            self.by_descr.setdefault(x['description'], []).append(i)
+            try:
+                key = (x['description'], frozenset(x['params'].iteritems()))
+            except (TypeError, AttributeError):
+                # parameter values that can't be compared to numbers anyway
+                continue
+            self.by_params.setdefault(key, []).append(i)
+
+        # sorted keys for prefix searches
+        self.hashes = sorted(self.by_hash)
+        self.descrs = sorted(self.by_descr)
+
+    def _prefixed(self, keys, table, prefix):
+        i = bisect.bisect_left(keys, prefix)
+        positions = []
+        while i < len(keys) and keys[i].startswith(prefix):
+            positions += table[keys[i]]
+            i += 1
+        # keep the order of nodes
+        positions.sort()
+        return positions
+
+    def match(self, s):
+        # in order of precedence; later lookups are only made if the
+        # earlier ones find nothing
+        lookups = (lambda: self.by_params.get(_parse_params_id(s)),
+                   lambda: self.by_descr.get(s),
+                   lambda: self._prefixed(self.descrs, self.by_descr, s),
+                   lambda: self.by_hash.get(s),
+                   lambda: self._prefixed(self.hashes, self.by_hash, s))
+        for lookup in lookups:
+            positions = lookup()
+            if positions:
+                return [self.nodes[i] for i in positions]
+        return []
+
+# The matcher for the last collection searched, since the same collection
+# tends to be searched many times over (e.g. while expanding a task file).
+# Code that changes a collection in place after searching it must call
+# forget_matcher.
+_last_matcher = (None, None)
+
+def forget_matcher():
+    global _last_matcher
+    _last_matcher = (None, None)
 
-    # search by: exact description match with parameters,
-    #  exact description match, prefix description
-    #  match, exact hash match, prefix hash match
-    for match_fn in (exact_params_match, exact_descr_match, prefix_descr_match,
-                     exact_match, prefix_match):
-        matches = [e for e in nodes if match_fn(e, s)]
-        if len(matches) > 0:
-            return matches
+# This function matches a description with a node. Copied from exp with minor changes
+def match(s, nodes):
+    global _last_matcher
+
+    cached_nodes, matcher = _last_matcher
+    if cached_nodes is not nodes:
+        matcher = exp_matcher(nodes)
+        _last_matcher = (nodes, matcher)
 
-    return []
+    return matcher.match(s)
 
 # Find a descr in nodes. Copied from exp with minor changes
 def find(descr, nodes=None):
@@ -150,82 +219,210 @@ def find(descr, nodes=None):
     matches = match(descr, nodes)
 
     # note: descending sort
-    matches.sort(lambda x, y: cmp(y.info['date'], x.info['date']))
+    matches.sort(lambda x, y: cmp(y['date'], x['date']))
 
     return matches
 
+def _freeze(obj):
+    """A hashable version of a parameter value or dictionary"""
+    if isinstance(obj, dict):
+        return frozenset((k, _freeze(v)) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return tuple(_freeze(x) for x in obj)
+    elif isinstance(obj, set):
+        return frozenset(_freeze(x) for x in obj)
+    return obj
+
+def compare_keys(k0, k1):
+    """cmp() for the keys of dominance.key, which are nested as deep as the
+    dependency chains: comparing them as tuples would recurse that deep"""
+    stack = [(k0, k1)]
+    while stack:
+        a, b = stack.pop()
+        if a is b:
+            continue
+        if not isinstance(a, tuple):
+            # dates, or numbers of dependencies
+            c = cmp(a, b)
+            if c:
+                return c
+            continue
+        (deps0, date0), (deps1, date1) = a, b
+        # in the order tuples compare in: the dependencies in turn, their
+        # number, then the date
+        stack.append((date0, date1))
+        stack.append((len(deps0), len(deps1)))
+        stack.extend(reversed(zip(deps0, deps1)))
+    return 0
+
+class dominance:
+    """Decides when the results of one experiment should supercede the
+    results of another. Experiments and their dependencies are looked up
+    by hash in infos (by default, the index), and each pair of
+    experiments is only ever compared once."""
+
+    def __init__(self, infos=None, extra=None):
+        if infos is None:
+            infos = exp_index.load()
+        self.infos = infos
+        self.extra = extra or {}
+        self.memo = {}
+        self.keys = {}
+
+    def info(self, hsh):
+        if hsh in self.extra:
+            return self.extra[hsh]
+        return self.infos.get(hsh)
+
+    def _dep_order(self, hsh):
+        # pair up dependencies by what they are rather than by the
+        # arbitrary order of the deps set
+        info = self.info(hsh)
+        if info is None:
+            return (None, None, hsh)
+        return (info['description'], _freeze(info.get('params')), hsh)
+
+    def compare(self, h0, h1):
+        """1 if h0 dominates h1, 0 if they are the same experiment, and None
+        otherwise"""
+        if h0 == h1:
+            return 0
+
+        # dependencies are compared before their dependents with a stack
+        # rather than by recursing, as dependency chains can be long
+        stack = [(h0, h1)]
+        while stack:
+            pair = stack[-1]
+            if pair in self.memo:
+                stack.pop()
+                continue
+
+            exp0, exp1 = self.info(pair[0]), self.info(pair[1])
+            result = None
+            # note that this may not always be what we want; sometimes we want
+            #  the latest code instead of the latest run
+            if (exp0 is None or exp1 is None or
+                exp0['description'] != exp1['description'] or
+                exp0.get('params') != exp1.get('params')):
+                result = None
+            elif exp0['deps'] == exp1['deps']:
+                if exp0['date'] > exp1['date']:
+                    result = 1
+            elif len(exp0['deps']) == len(exp1['deps']):
+                # pairs of the same experiment compare as 0
+                pairs = [(d0, d1) for d0, d1 in
+                         zip(sorted(exp0['deps'], key=self._dep_order),
+                             sorted(exp1['deps'], key=self._dep_order))
+                         if d0 != d1]
+                todo = [p for p in pairs if p not in self.memo]
+                if todo:
+                    stack.extend(todo)
+                    continue
+                if pairs and all(self.memo[p] == 1 for p in pairs):
+                    result = 1
+
+            self.memo[pair] = result
+            stack.pop()
+        return self.memo[(h0, h1)]
+
+    def dominates(self, h0, h1):
+        return self.compare(h0, h1) == 1
+
+    def key(self, hsh):
+        """A sort key under which every experiment comes after those it
+        dominates (compared with compare_keys): the keys of its
+        dependencies, paired up as in compare, then its date. Worked out
+        once for each hash, dependencies first."""
+        stack = [hsh]
+        while stack:
+            h = stack[-1]
+            if h in self.keys:
+                stack.pop()
+                continue
+            info = self.info(h)
+            if info is None:
+                self.keys[h] = ((), None)
+                stack.pop()
+                continue
+            deps = sorted(info['deps'], key=self._dep_order)
+            todo = [d for d in deps if d not in self.keys]
+            if todo:
+                stack.extend(todo)
+                continue
+            self.keys[h] = (tuple(self.keys[d] for d in deps), info['date'])
+            stack.pop()
+        return self.keys[hsh]
+
+    def frontier(self, exps):
+        """The experiments in exps not dominated by any other experiment in
+        exps, in their original order"""
+        # only experiments with the same description and parameters can
+        # dominate each other
+        partitions = {}
+        for exp in exps:
+            key = (exp['description'], _freeze(exp.get('params')))
+            partitions.setdefault(key, []).append(exp.hsh)
+
+        # in each partition, latest first: an experiment can then only be
+        # dominated by one already found not to be, since dominance is
+        # transitive
+        dominated = set()
+        for hashes in partitions.itervalues():
+            hashes.sort(lambda h0, h1: compare_keys(self.key(h0), self.key(h1)),
+                        reverse=True)
+            latest = []
+            for h in hashes:
+                if any(self.dominates(h0, h) for h0 in latest):
+                    dominated.add(h)
+                else:
+                    latest.append(h)
+
+        return [exp for exp in exps if exp.hsh not in dominated]
+
 def find_latest(exp_id):
     # remove dominated experiments
 
     matches = find(exp_id)
-    
-    # this is not very efficient
-    i = 0
-    while i < len(matches):
-        if any(dominates(x, matches[i]) for x in matches):
-            del matches[i]
-        else:
-            i += 1
-
-    return matches
+    return dominance(extra=dict((x.hsh, x) for x in matches)).frontier(matches)
         
 def dominates(exp0, exp1):
     return compare(exp0, exp1) > 0
 
-# this function doesn't return what you think it does
 def compare(exp0, exp1):
     """Defines when the results of one experiment should supercede the
-    results of another."""
-
-    if exp0.hsh == exp1.hsh:
-        return 0
+    results of another. See dominance."""
+    return dominance(extra={exp0.hsh: exp0, exp1.hsh: exp1}).compare(exp0.hsh, exp1.hsh)
 
-    # note that this may not always be what we want; sometimes we want
-    #  the latest code instead of the latest run
-
-    if (exp0['description'] != exp1['description'] or
-        exp0.get('params') != exp1.get('params')):
-        return None 
-
-    if exp0['deps'] == exp1['deps']:
-        if exp0['date'] > exp1['date']:
-            return 1
-    
-    if len(exp0['deps']) != len(exp1['deps']):
-        return None
-    
-    # note that there is a dependency ordering problem here
-    #  and another subtle bug
-    if (all(compare(*x) >= 0 for x in zip(exp0.deps(), exp1.deps())) and
-        any(dominates(*x) for x in zip(exp0.deps(), exp1.deps()))):
-        return 1
 
 
 
 
 
+# experiments are read from the index (see exp_index) rather than from
+# the individual descr files, as exp_records; use exp.node() to get a
+# dag_node. The list is reused until the index changes, so that a
+# process answering many queries (see exp_daemon) also reuses the matcher
+# built for it; don't modify it.
+_last_descrs = {}
 
-# should probably store some kind of index to avoid linear search
 def read_descrs(keep_unreadable=False, keep_unfinished=False, keep_failed=False,
                 keep_broken_deps=False):
-    resultsdir = os.path.join(util.abs_root_path(), RESULTS_DIR)
-
-    try:
-        exp_dirs = os.listdir(resultsdir)
-        
-    except OSError:
-        exp_dirs = []
-
+    entries = exp_index.load()
+    key = (keep_unfinished, keep_failed, keep_broken_deps)
+    cached = _last_descrs.get(key)
+    if cached is not None and cached[0] == exp_index.position():
+        sys.stderr.write('Finished reading descriptions...\n')
+        return cached[1]
+
+    broken = set() if keep_broken_deps else exp_index.broken_deps()
     exps = []
-
-    for exp_dir in exp_dirs:
-        exp = dag.dag_node(hsh = exp_dir)
- 
+    for exp in entries.itervalues():
         if (exp.success() or
             (exp.failure() and keep_failed) or
             keep_unfinished):
-            if keep_broken_deps or not exp.broken_deps():
+            if exp.hsh not in broken:
                 exps.append(exp)
 
+    _last_descrs[key] = (exp_index.position(), exps)
     sys.stderr.write('Finished reading descriptions...\n')
     return exps
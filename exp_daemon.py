@@ -0,0 +1,310 @@
+import os
+import sys
+import json
+import errno
+import socket
+import signal
+import time
+
+# exp_daemon.py: a per-repository daemon answering queries from memory.
+#
+# Every exp command starts python, imports everything and loads the store
+# before doing anything. With a daemon running (exp daemon start), exp
+# list, show, hash and print are sent to it over the Unix socket
+# .exp/daemon.sock instead, and it answers from the store it keeps in
+# memory: the index is followed as it is appended to (see exp_index.load),
+# and .exp/results is watched for experiments removed behind exp's back.
+# This module only imports the standard library until it is actually
+# serving, so that forward(), which exp.py calls before importing
+# anything else, costs next to nothing.
+#
+# Without a daemon, or if it doesn't answer, or with EXP_DAEMON=0, the
+# command runs directly as usual. Commands that would have to ask the
+# user something (e.g. print with a reference it can't match) are handed
+# back to be run directly too.
+
+# in exp_common.DOT_DIR, which isn't imported here to keep forward() cheap
+SOCKET = os.path.join('.exp', 'daemon.sock')
+LOG = os.path.join('.exp', 'daemon.log')
+
+COMMANDS = ('list', 'show', 'hash', 'print')
+
+# seconds to wait for an answer before running the command directly
+TIMEOUT = 60
+
+def socket_path(cwd=None):
+    """The daemon socket of the repository containing cwd, or None if there
+    is no daemon"""
+    d = os.path.abspath(cwd or os.getcwd())
+    while True:
+        if os.path.exists(os.path.join(d, '.git')):
+            path = os.path.join(d, SOCKET)
+            return path if os.path.exists(path) else None
+        parent = os.path.dirname(d)
+        if parent == d:
+            return None
+        d = parent
+
+def request(path, msg, timeout=TIMEOUT):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    try:
+        s.connect(path)
+        s.sendall(json.dumps(msg) + '\n')
+        s.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            block = s.recv(65536)
+            if not block:
+                break
+            data.append(block)
+    finally:
+        s.close()
+    return json.loads(''.join(data))
+
+def forward(argv):
+    """Have the daemon run an exp command, exiting with its status. Returns
+    if the command should be run directly instead."""
+    if (not argv or argv[0] not in COMMANDS or
+        os.environ.get('EXP_DAEMON', '') == '0'):
+        return
+    path = socket_path()
+    if path is None:
+        return
+    try:
+        response = request(path, {'argv': argv})
+    except (socket.error, ValueError):
+        return
+    if response.get('declined'):
+        return
+
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    sys.stderr.write(response['stderr'].encode('utf-8'))
+    sys.stdout.write(response['stdout'].encode('utf-8'))
+    sys.exit(response['status'])
+
+
+# The daemon
+
+class _output:
+    """Collects what a command prints"""
+    def __init__(self):
+        self.parts = []
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        self.parts.append(s)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+class _needs_terminal(Exception):
+    pass
+
+class _no_input:
+    """Stands in for stdin: commands that ask for input are run directly"""
+    def readline(self, *args):
+        raise _needs_terminal()
+    read = readline
+
+class results_watcher:
+    """Notices experiments removed from .exp/results without going through
+    exp (other changes are all recorded in the index)"""
+
+    def __init__(self, rootdir):
+        import exp_common
+        self.path = os.path.join(rootdir, exp_common.RESULTS_DIR)
+        self.mtime = None
+
+    def check(self):
+        import exp_index
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            present = set(os.listdir(self.path))
+        except OSError:
+            present = set()
+        if any(h not in present for h in exp_index.load()):
+            exp_index.rebuild()
+
+class daemon:
+
+    def __init__(self):
+        import exp, exp_common, exp_index, util
+        self.exp = exp
+        self.exp_common = exp_common
+        self.util = util
+        self.parser = exp.make_parser()
+        self.rootdir = util.abs_root_path()
+        self.watcher = results_watcher(self.rootdir)
+        self.started = time.time()
+        self.requests = 0
+        # load the store now rather than on the first request
+        exp_index.load()
+        self.watcher.check()
+
+    def run(self, argv):
+        """Run a command, returning the response to send"""
+        if not argv or argv[0] not in COMMANDS:
+            return {'declined': True}
+        self.watcher.check()
+        # caches that would go stale between requests
+        self.exp_common.all_nodes = None
+        self.exp_common.forget_matcher()
+        self.util._commits.clear()
+
+        out, err = _output(), _output()
+        saved = sys.stdin, sys.stdout, sys.stderr
+        sys.stdin, sys.stdout, sys.stderr = _no_input(), out, err
+        status = 0
+        try:
+            args = self.parser.parse_args(argv)
+            args.func(args)
+        except _needs_terminal:
+            return {'declined': True}
+        except SystemExit as e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                err.write('{}\n'.format(e.code))
+                status = 1
+        except Exception as e:
+            import traceback
+            traceback.print_exc(file=err)
+            status = 1
+        finally:
+            sys.stdin, sys.stdout, sys.stderr = saved
+        self.requests += 1
+        return {'status': status,
+                'stdout': out.getvalue().decode('utf-8', 'replace'),
+                'stderr': err.getvalue().decode('utf-8', 'replace')}
+
+    def handle(self, conn):
+        """Answer one request; returns False when asked to stop"""
+        data = ''
+        while not data.endswith('\n'):
+            block = conn.recv(65536)
+            if not block:
+                break
+            data += block
+        msg = json.loads(data)
+        if msg.get('stop'):
+            response = {'stopped': True}
+        elif msg.get('ping'):
+            import exp_index
+            response = {'pid': os.getpid(), 'experiments': len(exp_index.load()),
+                        'uptime': time.time() - self.started, 'requests': self.requests}
+        else:
+            response = self.run(msg['argv'])
+        conn.sendall(json.dumps(response))
+        return not msg.get('stop')
+
+    def serve(self, path):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        os.chmod(path, 0600)
+        s.listen(16)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                try:
+                    conn = s.accept()[0]
+                except socket.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    if not self.handle(conn):
+                        break
+                except Exception as e:
+                    sys.stderr.write('exp daemon: {}\n'.format(e))
+                finally:
+                    conn.close()
+        finally:
+            s.close()
+            os.remove(path)
+
+
+# exp daemon start/stop/status, run with the repository root
+
+def ping(path):
+    try:
+        return request(path, {'ping': True}, timeout=5)
+    except (socket.error, ValueError):
+        return None
+
+def start(rootdir, foreground=False):
+    path = os.path.join(rootdir, SOCKET)
+    if os.path.exists(path):
+        info = ping(path)
+        if info is not None:
+            print 'exp daemon already running (pid {})'.format(info['pid'])
+            return
+        # left behind by a daemon that died
+        os.remove(path)
+
+    if foreground:
+        daemon().serve(path)
+        return
+
+    pid = os.fork()
+    if pid == 0:
+        # detach from the terminal and our parent
+        os.setsid()
+        if os.fork() != 0:
+            os._exit(0)
+        with open(os.devnull) as null:
+            os.dup2(null.fileno(), 0)
+        with open(os.path.join(rootdir, LOG), 'a') as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        status = 0
+        try:
+            daemon().serve(path)
+        except SystemExit:
+            pass
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+
+    os.waitpid(pid, 0)
+    for i in range(100):
+        info = os.path.exists(path) and ping(path)
+        if info:
+            print 'Started exp daemon (pid {}, {} experiments)'.format(
+                info['pid'], info['experiments'])
+            return
+        time.sleep(0.1)
+    print 'exp daemon did not start; see {}'.format(os.path.join(rootdir, LOG))
+    exit(1)
+
+def stop(rootdir):
+    path = os.path.join(rootdir, SOCKET)
+    try:
+        request(path, {'stop': True}, timeout=5)
+    except (socket.error, ValueError):
+        print 'No exp daemon running'
+        return
+    print 'Stopped exp daemon'
+
+def status(rootdir):
+    path = os.path.join(rootdir, SOCKET)
+    info = ping(path) if os.path.exists(path) else None
+    if info is None:
+        print 'No exp daemon running'
+        return
+    print 'exp daemon running (pid {}): {} experiments, {} requests in {:.0f}s'.format(
+        info['pid'], info['experiments'], info['requests'], info['uptime'])
@@ -0,0 +1,334 @@
+import os
+import json
+
+import util, exp_common, dag, serialize, exp_record
+
+# exp_index.py: a persistent index of the results store, so that queries
+# read a single file instead of every descr file under .exp/results.
+#
+# The index is an append-only journal with one record per line, after a
+# version line. Each record is [hash, info] as JSON (see serialize), or
+# [hash, null] when an experiment has been removed; later records for the
+# same hash override earlier ones. The info leaves out the fields that
+# exp_record reads from the descr file when needed (see
+# exp_record.index_info). Since records are only ever appended, updating the index when an experiment
+# changes state costs one small write no matter how large the store is.
+# rebuild() regenerates (and compacts) the journal from the descr files.
+
+# In-process cache of the journal, so that repeated loads only read the
+# records appended since the last load.
+_cache = {'path': None, 'ino': None, 'offset': 0, 'entries': None}
+
+# In-process copy of the dependency validity cache (see broken_deps)
+_validity = None
+
+def index_path(rootdir=None):
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    return os.path.join(rootdir, exp_common.INDEX_FILE)
+
+def _index_path_for_descr(descr_path):
+    """The index belonging to a store, given the path to one of its descr
+    files (.exp/results/<hash>/descr)"""
+    resultsdir = os.path.dirname(os.path.dirname(os.path.abspath(descr_path)))
+    return os.path.join(os.path.dirname(resultsdir),
+                        os.path.basename(exp_common.INDEX_FILE))
+
+def _format_record(hsh, info):
+    if info is not None:
+        info = exp_record.index_info(info)
+    return serialize.dumps_value([hsh, info]) + '\n'
+
+def validity_path(rootdir=None):
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    return os.path.join(rootdir, exp_common.VALIDITY_FILE)
+
+HEADER = 'exp-index {}\n'.format(serialize.FORMAT_VERSION)
+
+def _record_hash(line):
+    # records start with the JSON of a [hash, info] list
+    return line[2:line.index('"', 2)]
+
+def _parse_records(lines, entries):
+    # a torn final line (e.g. from a crashed writer) is ignored; a rebuild
+    # will recover the record from the descr file
+    lines = [l for l in lines if l.endswith('\n') and l != HEADER]
+
+    try:
+        # decoding everything with one call to json is much faster than
+        # decoding line by line
+        records = json.loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+
+    for record in records:
+        hsh, info = serialize._decode(record)
+        if info is None:
+            entries.pop(hsh, None)
+        else:
+            entries[hsh] = exp_record.exp_record(hsh, info)
+
+def _append(path, hsh, info):
+    if not os.path.exists(path):
+        # no index yet; the first load will build one from the descr files
+        return
+    # a single write of a single line, opened for appending, so that
+    # concurrent writers don't interleave records
+    with open(path, 'a') as f:
+        f.write(_format_record(hsh, info))
+
+def update(descr_path, info):
+    """Record the new state of the experiment whose descr file is at
+    descr_path"""
+    update_many([(descr_path, info)])
+
+def update_many(descrs):
+    """Record the new states of a batch of (descr path, info) pairs, with
+    one write per index. Called from dag.save_descrs."""
+    records = {}
+    for descr_path, info in descrs:
+        hsh = os.path.basename(os.path.dirname(os.path.abspath(descr_path)))
+        path = _index_path_for_descr(descr_path)
+        records.setdefault(path, []).append(_format_record(hsh, info))
+
+    for path, lines in records.iteritems():
+        if not os.path.exists(path):
+            # no index yet; the first load will build one from the descr files
+            continue
+        with open(path, 'a') as f:
+            f.write(''.join(lines))
+
+def remove(hsh, rootdir=None):
+    """Record that an experiment has been removed from the store"""
+    _append(index_path(rootdir), hsh, None)
+
+def rebuild(rootdir=None):
+    """Regenerate the index from the descr files in the results directory"""
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    path = index_path(rootdir)
+    resultsdir = os.path.join(rootdir, exp_common.RESULTS_DIR)
+
+    try:
+        exp_dirs = os.listdir(resultsdir)
+    except OSError:
+        exp_dirs = []
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    # write to a temporary file and rename, so that readers never see a
+    # half-written index
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    entries = {}
+    with open(tmp_path, 'w') as f:
+        f.write(HEADER)
+        for hsh in exp_dirs:
+            info = dag.load_info(hsh, rootdir=rootdir)
+            if info is None:
+                continue
+            entries[hsh] = info
+            f.write(_format_record(hsh, info))
+    os.rename(tmp_path, path)
+
+    _cache['path'] = None
+    return entries
+
+def _cached(path, st):
+    """Whether _cache holds the start of the index file with stat st"""
+    return (_cache['path'] == path and _cache['ino'] == st.st_ino and
+            st.st_size >= _cache['offset'])
+
+def load(rootdir=None):
+    """Return a dictionary mapping the hash of every experiment in the
+    store to its exp_record, building the index first if there isn't one"""
+    path = index_path(rootdir)
+
+    if not os.path.exists(path):
+        rebuild(rootdir)
+    f = open(path)
+    st = os.fstat(f.fileno())
+    # the header only needs checking when the file is new to us; this is
+    # called for every record by has_broken_deps, so it must be cheap
+    if not _cached(path, st) and f.readline() != HEADER:
+        # written by an older version
+        f.close()
+        rebuild(rootdir)
+        f = open(path)
+        st = os.fstat(f.fileno())
+
+    with f:
+        if not _cached(path, st):
+            # first load, or the index has been rebuilt since
+            _cache['path'] = path
+            _cache['ino'] = st.st_ino
+            _cache['offset'] = 0
+            _cache['entries'] = {}
+        f.seek(_cache['offset'])
+        lines = f.readlines()
+
+    # only advance past complete records
+    if lines and not lines[-1].endswith('\n'):
+        _cache['offset'] += sum(len(l) for l in lines[:-1])
+    else:
+        _cache['offset'] += sum(len(l) for l in lines)
+    _parse_records(lines, _cache['entries'])
+
+    return _cache['entries']
+
+def position():
+    """The position of the journal as of the last load, to find out later
+    what has changed since (see changed_since)"""
+    return _cache['ino'], _cache['offset']
+
+def changed_since(pos, rootdir=None):
+    """Hashes of the experiments recorded (or removed) since the journal
+    was at pos, or None if it has been rebuilt since, so that anything may
+    have changed"""
+    load(rootdir)
+    ino, offset = pos
+    if ino != _cache['ino'] or offset > _cache['offset']:
+        return None
+    return _changed_since(_cache['path'], offset, _cache['offset'])
+
+
+# Dependency validity: an experiment has broken dependencies if any of its
+# transitive dependencies is missing from the store or did not succeed.
+# This is computed once over the whole store and saved together with the
+# journal position it corresponds to. When the journal grows, only the
+# experiments recorded since then and the experiments depending on them
+# are recomputed.
+
+def _compute_broken(entries, hashes, broken):
+    """Recompute whether each experiment in hashes has broken deps,
+    visiting dependencies before dependents. Results for experiments not
+    in hashes are taken from broken."""
+    done = {}
+    visiting = set()
+
+    for root in hashes:
+        if root in done:
+            continue
+        stack = [root]
+        while stack:
+            hsh = stack[-1]
+            if hsh in done:
+                stack.pop()
+                continue
+            if hsh not in visiting:
+                # first visit: resolve the dependencies first
+                visiting.add(hsh)
+                stack.extend(d for d in entries[hsh]['deps']
+                             if d in hashes and d not in done and
+                             d not in visiting)
+                continue
+            stack.pop()
+            is_broken = False
+            for d in entries[hsh]['deps']:
+                if (d not in entries or
+                    entries[d]['run_state'] != dag.RUN_STATE_SUCCESS):
+                    is_broken = True
+                elif d in hashes:
+                    # visiting d already (a cycle) counts as not broken
+                    is_broken = done.get(d, False)
+                else:
+                    is_broken = d in broken
+                if is_broken:
+                    break
+            done[hsh] = is_broken
+
+    for hsh, is_broken in done.iteritems():
+        if is_broken:
+            broken.add(hsh)
+        else:
+            broken.discard(hsh)
+
+def _dependents(entries, hashes):
+    """The experiments in hashes plus everything that transitively depends
+    on them"""
+    children = {}
+    for hsh, info in entries.iteritems():
+        for d in info['deps']:
+            children.setdefault(d, []).append(hsh)
+
+    result = set()
+    stack = list(hashes)
+    while stack:
+        hsh = stack.pop()
+        if hsh in result:
+            continue
+        result.add(hsh)
+        stack.extend(children.get(hsh, ()))
+    return result
+
+def _changed_since(path, start, end):
+    """Hashes of the records between two offsets of the journal"""
+    with open(path) as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines()
+    return set(_record_hash(l) for l in lines if l)
+
+def broken_deps(rootdir=None):
+    """Return the set of hashes of experiments in the store with broken
+    dependencies"""
+    global _validity
+
+    entries = load(rootdir)
+    path = validity_path(rootdir)
+    state = _validity
+
+    if state is None:
+        try:
+            with open(path) as f:
+                state = serialize.loads_value(f.read())
+        except (IOError, ValueError):
+            state = None
+
+    if (state is not None and state['ino'] == _cache['ino'] and
+        state['offset'] == _cache['offset']):
+        _validity = state
+        return state['broken']
+
+    if (state is not None and state['ino'] == _cache['ino'] and
+        state['offset'] < _cache['offset']):
+        changed = _changed_since(_cache['path'], state['offset'],
+                                 _cache['offset'])
+        stale = set(h for h in _dependents(entries, changed) if h in entries)
+        broken = set(h for h in state['broken'] if h in entries)
+    else:
+        stale = set(entries)
+        broken = set()
+
+    _compute_broken(entries, stale, broken)
+
+    _validity = {'ino': _cache['ino'], 'offset': _cache['offset'],
+                 'broken': broken}
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(serialize.dumps_value(_validity))
+            f.write('\n')
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # the cache is only an optimization
+        pass
+
+    return broken
+
+def has_broken_deps(hsh, deps, rootdir=None):
+    """Whether an experiment has broken dependencies. Experiments not in
+    the store yet are checked against their direct dependencies."""
+    broken = broken_deps(rootdir)
+    entries = _cache['entries']
+
+    if hsh in entries:
+        return hsh in broken
+    return any(d not in entries or
+               entries[d]['run_state'] != dag.RUN_STATE_SUCCESS or
+               d in broken for d in deps)
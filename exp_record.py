@@ -0,0 +1,158 @@
+import os
+
+import util, exp_common, exp_index, dag
+
+# exp_record.py: compact, read-only records of stored experiments.
+#
+# Queries (exp list, exp show, find, ...) only need to look at stored
+# experiments, so they get exp_records rather than dag_nodes. A record
+# keeps the commonly used fields in slots, shares strings (descriptions,
+# commits, commands, parameter names, hashes) and identical parameter
+# dictionaries between records, and leaves the long, unique final
+# command/code, timings and usage in the descr file until someone asks
+# for them; the index doesn't hold them either (see index_info). Records
+# support the same lookups as dag_nodes (exp['description'], exp.get,
+# 'date_end' in exp, success(), ...); node() gives a dag_node when the
+# experiment is actually going to be used as one.
+
+FIELDS = ('description', 'command', 'code', 'commit', 'date', 'date_end',
+          'run_state', 'return_code', 'params', 'deps', 'working_dir')
+
+# fields only read from the descr file when needed
+LAZY_FIELDS = ('final_command', 'final_code', 'timing', 'usage')
+
+# the key under which the index lists the lazy fields an experiment has
+LAZY_KEY = 'lazy_fields'
+
+_MISSING = object()
+
+_params = {}
+_extras = {}
+
+def _intern(s):
+    if isinstance(s, str):
+        return intern(s)
+    return s
+
+def _share_params(params):
+    """Return a dictionary equal to params, shared with all other records
+    with the same parameters"""
+    if not isinstance(params, dict):
+        return params
+    params = dict((_intern(k), v) for k, v in params.iteritems())
+    try:
+        key = frozenset(params.iteritems())
+    except TypeError:
+        # unhashable values; don't share
+        return params
+    return _params.setdefault(key, params)
+
+def _share(d, pool):
+    try:
+        key = frozenset(d.iteritems())
+    except TypeError:
+        return d
+    return pool.setdefault(key, d)
+
+def index_info(info):
+    """What the index records of info: everything but the lazy fields,
+    which are only listed"""
+    lazy = [name for name in LAZY_FIELDS if name in info]
+    if not lazy:
+        return info
+    info = dict((k, v) for k, v in info.iteritems() if k not in LAZY_FIELDS)
+    info[LAZY_KEY] = lazy
+    return info
+
+class exp_record(object):
+    __slots__ = ('hsh', 'lazy', 'extra') + FIELDS
+
+    def __init__(self, hsh, info):
+        self.hsh = intern(hsh)
+        for name in FIELDS:
+            setattr(self, name, info.get(name, _MISSING))
+
+        for name in ('description', 'command', 'commit', 'working_dir'):
+            setattr(self, name, _intern(getattr(self, name)))
+        self.params = _share_params(self.params)
+        if self.deps is not _MISSING:
+            self.deps = frozenset(intern(d) for d in self.deps)
+
+        self.lazy = tuple(name for name in LAZY_FIELDS
+                          if name in info or name in info.get(LAZY_KEY, ()))
+
+        extra = dict((_intern(k), v) for k, v in info.iteritems()
+                     if k not in FIELDS and k not in LAZY_FIELDS and k != LAZY_KEY)
+        self.extra = _share(extra, _extras) if extra else None
+
+    def __getitem__(self, name):
+        if name in FIELDS:
+            value = getattr(self, name)
+            if value is _MISSING:
+                raise KeyError(name)
+            return value
+        if self.extra is not None and name in self.extra:
+            return self.extra[name]
+        if name in self.lazy:
+            info = dag.load_info(self.hsh, fields=(name,))
+            if info is not None and name in info:
+                return info[name]
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        if name in FIELDS:
+            return getattr(self, name) is not _MISSING
+        return ((self.extra is not None and name in self.extra) or
+                name in self.lazy)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    @property
+    def info(self):
+        """The full info dictionary, as saved in the descr file"""
+        info = dict((name, getattr(self, name)) for name in FIELDS
+                    if getattr(self, name) is not _MISSING)
+        if 'deps' in info:
+            info['deps'] = set(info['deps'])
+        if isinstance(info.get('params'), dict):
+            info['params'] = dict(info['params'])
+        if self.extra is not None:
+            info.update(self.extra)
+        if self.lazy:
+            info.update(dag.load_info(self.hsh, fields=self.lazy) or {})
+        return info
+
+    def node(self):
+        """A dag_node for this experiment"""
+        return dag.dag_node(hsh=self.hsh, info=self.info)
+
+    def success(self):
+        return self.run_state == dag.RUN_STATE_SUCCESS
+
+    def failure(self):
+        return self.run_state == dag.RUN_STATE_FAIL
+
+    def running(self):
+        """Running or killed... should be able to distinguish these two somehow"""
+        return self.run_state == dag.RUN_STATE_RUNNING
+
+    def broken_deps(self):
+        return exp_index.has_broken_deps(self.hsh, self.deps)
+
+    def deps_records(self):
+        entries = exp_index.load()
+        return [entries[hsh] for hsh in self.deps if hsh in entries]
+
+    def filename(self, name):
+        return os.path.join(util.abs_root_path(), exp_common.RESULTS_DIR,
+                            self.hsh, name)
+
+    def param(self, name):
+        return self.params[name]
+
+    def __repr__(self):
+        return '<exp_record {} {}>'.format(self.hsh[:6], self.description)
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import shlex
+import errno
+import select
+import signal
+import subprocess
+import fcntl
+import time
+import runpy
+import random
+import traceback
+import distutils.spawn
+
+import dag, local_backend, job_wrapper
+
+# forkserver_backend.py: a backend for many short Python jobs.
+#
+# Starting a job with local_backend costs a bash script, a shell, tee and
+# a fresh Python interpreter that then has to import everything the job
+# uses, which for short jobs takes longer than the job itself. This
+# backend instead keeps a server process (this file, run with --serve)
+# that has already imported the modules named in EXP_FORKSERVER_PRELOAD
+# (comma separated, e.g. numpy,scipy), and forks it for each job: the
+# child changes into the job's directory, sets up its environment and
+# output files, and runs the script as __main__.
+#
+# Only commands of the form 'python script.py args...' (or 'python -m
+# module args...'), with no shell syntax, where python is the interpreter
+# running exp, are run this way; everything else is passed on to
+# local_backend. The server collects each job's output and writes its
+# status file the way job_wrapper does.
+#
+# The server reads one JSON request per line on stdin, and answers with
+# one line per finished job, [job id, exit status].
+
+PRELOAD = ''
+
+# a command using any of these needs a shell
+SHELL_CHARS = set('|&;<>()$`*?[]{}~!#\n\\')
+
+def preload_modules():
+    return [m for m in os.environ.get('EXP_FORKSERVER_PRELOAD', PRELOAD).split(',')
+            if m.strip()]
+
+def _our_python():
+    """The names under which a job's command can refer to this
+    interpreter"""
+    names = set([sys.executable])
+    here = os.path.realpath(sys.executable)
+    for name in ('python', 'python2', 'python{}.{}'.format(*sys.version_info[:2])):
+        path = distutils.spawn.find_executable(name)
+        if path is not None and os.path.realpath(path) == here:
+            names.add(name)
+    return names
+
+def parse_command(cmd, pythons):
+    """The arguments to python in cmd, if it can be run in the fork server,
+    and None otherwise"""
+    if cmd is None or any(c in SHELL_CHARS for c in cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    if len(argv) < 2 or argv[0] not in pythons:
+        return None
+    if argv[1] == '-m' and len(argv) >= 3:
+        return argv[1:]
+    if argv[1].startswith('-'):
+        return None
+    return argv[1:]
+
+class forkserver_backend:
+
+    def __init__(self):
+        self.local = local_backend.local_backend()
+        self.pythons = _our_python()
+        self.server = None
+        self.buf = ''
+        self.next_id = 0
+        # job id -> exit status of jobs that have finished
+        self.results = {}
+        # job ids sent to the current server
+        self.outstanding = set()
+
+    def start_server(self):
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'),
+             '--serve'] + preload_modules(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.buf = ''
+
+    def run(self, node):
+        args = parse_command(node.new_cmd, self.pythons)
+        if args is None:
+            return self.local.run(node)
+
+        if self.server is None or self.server.poll() is not None:
+            self.start_server()
+
+        cwd = os.path.join(node.expdir, node.working_dir)
+        env = {'EXP_RESULTS_DIR': node.exp_results,
+               'PATH': os.environ.get('PATH', '') + ':' + cwd}
+        if len(node.parents) == 1:
+            env['EXP_PARENT_RESULTS_DIR'] = list(node.parents)[0].exp_results
+
+        self.next_id += 1
+        request = {'id': self.next_id, 'args': args, 'cwd': cwd, 'env': env,
+                   'results': node.exp_results}
+        print 'Running command ' + node.new_cmd + ' in directory ' + cwd
+        try:
+            self.server.stdin.write(json.dumps(request) + '\n')
+            self.server.stdin.flush()
+        except IOError:
+            # the server died; run this one the slow way
+            self.server = None
+            return self.local.run(node)
+
+        self.outstanding.add(self.next_id)
+        node.jobid = self.next_id
+        return node.jobid
+
+    def read_results(self, timeout):
+        """Collect the statuses the server has sent, waiting up to timeout
+        seconds (None: indefinitely) for the first one"""
+        if self.server is None:
+            return
+        fd = self.server.stdout.fileno()
+        try:
+            ready = select.select([fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if not ready:
+            return
+
+        data = os.read(fd, 65536)
+        if not data:
+            # the server exited; whatever it was running is lost
+            for jobid in self.outstanding:
+                self.results[jobid] = None
+            self.outstanding = set()
+            self.server = None
+            return
+
+        self.buf += data
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            jobid, status = json.loads(line)
+            self.results[jobid] = status
+            self.outstanding.discard(jobid)
+
+    def wait(self, nodes, timeout=None):
+        forked = [n for n in nodes if isinstance(n.jobid, int)]
+        if not forked:
+            return self.local.wait(nodes, timeout)
+        if any(n.jobid in self.results for n in forked):
+            return
+        # local jobs are only noticed every timeout seconds here
+        local = len(forked) < len(nodes)
+        self.read_results(timeout if local else None)
+
+    def get_state(self, node):
+        if not isinstance(node.jobid, int):
+            return self.local.get_state(node)
+        if node.info['run_state'] != dag.RUN_STATE_RUNNING:
+            return node.info['run_state'], node.info['return_code']
+
+        self.read_results(0)
+        if node.jobid not in self.results:
+            return dag.RUN_STATE_RUNNING, None
+
+        status = self.results.pop(node.jobid)
+        if status is None:
+            print "Command '%s' was lost when the fork server exited" % node.new_cmd
+            return dag.RUN_STATE_FAIL, None
+        print "Command '%s' exited with status %d." % (node.new_cmd, status)
+        info = job_wrapper.read_status(node.exp_results)
+        node.info['date_end'] = info['end'] if info else time.time()
+        if status == 0:
+            return dag.RUN_STATE_SUCCESS, status
+        return dag.RUN_STATE_FAIL, status
+
+
+# The server
+
+def run_job(request, out, err):
+    """Run a job in a forked child, with its output going to the file
+    descriptors out and err; never returns"""
+    status = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+        os.chdir(request['cwd'])
+        os.environ.update((k.encode('utf-8'), v.encode('utf-8'))
+                          for k, v in request['env'].iteritems())
+        null = os.open(os.devnull, os.O_RDONLY)
+        for fd, target in ((null, 0), (out, 1), (err, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = os.fdopen(0, 'r')
+        sys.stdout = os.fdopen(1, 'w')
+        sys.stderr = os.fdopen(2, 'w', 0)
+
+        # a job importing e.g. util should get its own, not ours
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name, module in sys.modules.items():
+            path = getattr(module, '__file__', None)
+            if path is not None and os.path.dirname(os.path.abspath(path)) == here:
+                del sys.modules[name]
+
+        # don't let every job start with the server's random state
+        random.seed()
+        if 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+
+        args = [a.encode('utf-8') for a in request['args']]
+        if args[0] == '-m':
+            sys.argv = args[1:]
+            runpy.run_module(args[1], run_name='__main__', alter_sys=True)
+        else:
+            sys.argv = args
+            sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+            runpy.run_path(args[0], run_name='__main__')
+        status = 0
+    except SystemExit as e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            sys.stderr.write('{}\n'.format(e.code))
+            status = 1
+    except:
+        traceback.print_exc()
+        status = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(status & 0xff)
+
+class job:
+    """A job running in a child of the server. It is done once it has
+    exited and all its output has been read."""
+
+    def __init__(self, request):
+        self.id = request['id']
+        self.results = request['results']
+        self.logs = job_wrapper.open_logs(self.results)
+        self.start = time.time()
+        self.end = None
+        self.status = None
+        self.usage = None
+        # read end of the output pipe -> log
+        self.pipes = {}
+
+    def done(self):
+        return self.status is not None and not self.pipes
+
+    def finish(self):
+        for log in self.logs:
+            log.close()
+        status = {'return_code': self.status, 'start': self.start, 'end': self.end}
+        if self.usage is not None:
+            status['usage'] = self.usage
+        job_wrapper.write_status(self.results, status)
+
+def serve(modules):
+    for m in modules:
+        try:
+            __import__(m)
+        except Exception as e:
+            sys.stderr.write('fork server: could not preload {}: {}\n'.format(m, e))
+
+    # wake up select when a job exits
+    rpipe, wpipe = os.pipe()
+    for fd in (rpipe, wpipe):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wpipe)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    # pid -> job, and output pipe -> job
+    children = {}
+    outputs = {}
+    buf = ''
+    # whether exp is still there to send requests
+    reading = True
+    while reading or children:
+        fds = [rpipe] + outputs.keys() + ([0] if reading else [])
+        try:
+            ready = select.select(fds, [], [])[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        finished = []
+        for fd in ready:
+            if fd in outputs:
+                j = outputs[fd]
+                data = os.read(fd, 65536)
+                if data:
+                    j.pipes[fd].write(data)
+                    continue
+                os.close(fd)
+                del outputs[fd]
+                del j.pipes[fd]
+                finished.append(j)
+
+        if rpipe in ready:
+            try:
+                os.read(rpipe, 4096)
+            except OSError:
+                pass
+            while children:
+                try:
+                    pid, sts, ru = os.wait3(os.WNOHANG)
+                except OSError:
+                    break
+                if pid == 0:
+                    break
+                j = children[pid]
+                j.status = job_wrapper.exit_status(sts)
+                j.usage = job_wrapper.usage(ru)
+                j.end = time.time()
+                finished.append(j)
+
+        for pid, j in children.items():
+            if j in finished and j.done():
+                del children[pid]
+                j.finish()
+                if reading:
+                    os.write(1, json.dumps([j.id, j.status]) + '\n')
+
+        if 0 in ready:
+            data = os.read(0, 65536)
+            if not data:
+                # exp has exited; let the running jobs finish
+                reading = False
+                continue
+            buf += data
+            lines = buf.split('\n')
+            buf = lines.pop()
+            for line in lines:
+                request = json.loads(line)
+                j = job(request)
+                out_r, out_w = os.pipe()
+                err_r, err_w = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    for fd in [rpipe, wpipe, out_r, err_r] + outputs.keys():
+                        os.close(fd)
+                    run_job(request, out_w, err_w)
+                os.close(out_w)
+                os.close(err_w)
+                j.pipes = {out_r: j.logs[0], err_r: j.logs[1]}
+                outputs[out_r] = outputs[err_r] = j
+                children[pid] = j
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2:])
+    else:
+        print 'usage: forkserver_backend.py --serve [module...]'
+        exit(1)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import gzip
+import errno
+import shutil
+import select
+import signal
+import subprocess
+import time
+import argparse
+
+import util
+
+# job_wrapper.py: runs a job's command, capturing its output and exit
+# status.
+#
+#   job_wrapper.py [--tee] <results dir> <command> [args...]
+#
+# The command's stdout and stderr go to log and log.err in the results
+# directory. Each log is capped at EXP_LOG_MAX_SIZE (e.g. 100M; default
+# MAX_LOG_SIZE megabytes): when it gets there, it is rotated to log.1
+# (log.1 to log.2, and so on, keeping EXP_LOG_BACKUPS old logs), gzipped
+# if EXP_LOG_COMPRESS is set. With --tee, the output is also passed on to
+# our own stdout and stderr.
+#
+# When the command exits, its exit status, start and end times and
+# resource usage are written to the status file in the results directory
+# as a JSON object, so backends find out how a job ended without reading
+# its log (see read_status). The usage (see usage) covers the command and
+# every process it waited for. If EXP_SAMPLE_MEMORY is set to a number of
+# seconds, the memory of the whole process tree is also sampled that
+# often, which catches peaks of processes running side by side that the
+# maximum resident set size of any one of them doesn't. The wrapper exits
+# with the command's status.
+#
+# Processes the command leaves running in the background may still hold
+# its stdout or stderr. Their output is only collected for DRAIN_TIMEOUT
+# seconds after the command exits, so that they don't keep the job (and
+# its slot) from finishing.
+
+# the path to run the wrapper by
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_wrapper.py')
+
+STATUS_FILE = 'status'
+LOG_FILE = 'log'
+ERR_FILE = 'log.err'
+
+MAX_LOG_SIZE = 1024
+LOG_BACKUPS = 1
+
+# seconds to keep reading output once the command has exited, and how
+# often to check whether it has (besides when SIGCHLD arrives)
+DRAIN_TIMEOUT = 2
+EXIT_CHECK = 1
+
+def sample_interval():
+    try:
+        return float(os.environ['EXP_SAMPLE_MEMORY']) or None
+    except (KeyError, ValueError):
+        return None
+
+def log_settings():
+    try:
+        max_size = util.parse_size(os.environ['EXP_LOG_MAX_SIZE'])
+    except (KeyError, ValueError):
+        max_size = MAX_LOG_SIZE
+    try:
+        backups = int(os.environ['EXP_LOG_BACKUPS'])
+    except (KeyError, ValueError):
+        backups = LOG_BACKUPS
+    compress = os.environ.get('EXP_LOG_COMPRESS', '') not in ('', '0')
+    return max_size * 1024 * 1024, backups, compress
+
+class capped_log:
+    """A log file that is rotated whenever it reaches max_size bytes"""
+
+    def __init__(self, path, max_size, backups, compress):
+        self.path = path
+        self.max_size = max_size
+        self.backups = backups
+        self.compress = compress
+        self.f = open(path, 'wb')
+        self.size = 0
+
+    def backup_name(self, i):
+        return '{}.{}{}'.format(self.path, i, '.gz' if self.compress else '')
+
+    def rotate(self):
+        self.f.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(self.backup_name(i)):
+                    os.rename(self.backup_name(i), self.backup_name(i + 1))
+            if self.compress:
+                with open(self.path, 'rb') as src:
+                    with gzip.open(self.backup_name(1), 'wb') as dest:
+                        shutil.copyfileobj(src, dest)
+            else:
+                os.rename(self.path, self.backup_name(1))
+        self.f = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        while data:
+            if self.max_size and self.size >= self.max_size:
+                self.rotate()
+            n = len(data)
+            if self.max_size:
+                n = min(n, self.max_size - self.size)
+            self.f.write(data[:n])
+            self.size += n
+            data = data[n:]
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+def open_logs(results_dir):
+    max_size, backups, compress = log_settings()
+    return (capped_log(os.path.join(results_dir, LOG_FILE), max_size, backups, compress),
+            capped_log(os.path.join(results_dir, ERR_FILE), max_size, backups, compress))
+
+def pump(sources, tick=None, interval=None, exited=None):
+    """Copy data from file descriptors to their sinks until all of them are
+    at end of file. sources maps descriptors to lists of objects with a
+    write method. tick, if given, is called at least every interval
+    seconds. exited, if given, says whether the process writing to them
+    has exited; DRAIN_TIMEOUT seconds after it has, pump returns even if
+    some are still open."""
+    sources = dict(sources)
+    deadline = None
+    while sources:
+        if tick is not None:
+            tick()
+        timeout = interval
+        if exited is not None:
+            if deadline is None and exited():
+                deadline = time.time() + DRAIN_TIMEOUT
+            if deadline is None:
+                timeout = EXIT_CHECK
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return
+            if interval is not None:
+                timeout = min(timeout, interval)
+        try:
+            ready = select.select(sources.keys(), [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if not data:
+                del sources[fd]
+                continue
+            for sink in sources[fd]:
+                sink.write(data)
+
+def exit_status(sts):
+    """Exit status of a shell-style command from a waitpid status"""
+    if os.WIFSIGNALED(sts):
+        return 128 + os.WTERMSIG(sts)
+    return os.WEXITSTATUS(sts)
+
+def usage(ru):
+    """What the status file records of a job's rusage: user and system CPU
+    seconds, maximum resident set size in kilobytes, and blocks read and
+    written"""
+    max_rss = ru.ru_maxrss
+    if sys.platform == 'darwin':
+        # in bytes there
+        max_rss //= 1024
+    return {'user': ru.ru_utime, 'sys': ru.ru_stime, 'max_rss': max_rss,
+            'inblock': ru.ru_inblock, 'oublock': ru.ru_oublock}
+
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+def tree_rss(pid):
+    """Resident memory in kilobytes of a process and all its descendants,
+    from /proc (0 where there is none)"""
+    children = {}
+    rss = {}
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return 0
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # fields from the state on; the name before it may contain spaces
+        fields = stat[stat.rindex(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(name))
+        rss[int(name)] = int(fields[21])
+
+    total = 0
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        total += rss.get(p, 0)
+        stack.extend(children.get(p, ()))
+    return total * PAGE_KB
+
+class memory_sampler:
+    """Keeps track of the peak memory of a process tree"""
+
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+
+    def sample(self):
+        if time.time() - self.last >= self.interval:
+            self.last = time.time()
+            self.peak = max(self.peak, tree_rss(self.pid))
+
+def write_status(results_dir, status):
+    """Atomically write a job's status (a dictionary)"""
+    path = os.path.join(results_dir, STATUS_FILE)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(status, sort_keys=True) + '\n')
+    os.rename(tmp_path, path)
+
+def read_status(results_dir):
+    """The status written by a job that has exited, or None"""
+    try:
+        with open(os.path.join(results_dir, STATUS_FILE)) as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+def tail(path, n):
+    """The last n lines of a file, reading it backwards a block at a
+    time rather than reading all of it"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = ''
+        # one more newline than lines wanted, unless the file ends first
+        while pos > 0 and data.count('\n', 0, len(data) - 1) < n:
+            block = min(8192, pos)
+            pos -= block
+            f.seek(pos)
+            data = f.read(block) + data
+    lines = data.splitlines(True)
+    return lines[-n:] if n > 0 else []
+
+class _stream:
+    """Unbuffered writes to one of our own file descriptors"""
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError:
+            # nobody is reading anymore; the log still gets everything
+            pass
+
+def run(results_dir, argv, tee=False):
+    out, err = open_logs(results_dir)
+
+    start = time.time()
+    ru = None
+    sampler = None
+    try:
+        p = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, close_fds=True)
+    except OSError as e:
+        err.write('Could not run {}: {}\n'.format(argv[0], e.strerror))
+        status = 127
+        end = time.time()
+    else:
+        # pass on requests to stop to the job, and stay around to record
+        # how it ended; an interrupt from the terminal reaches the job
+        # directly
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: p.send_signal(signum))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # only to interrupt pump's select when the command exits
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        sinks = {p.stdout.fileno(): [out], p.stderr.fileno(): [err]}
+        if tee:
+            sinks[p.stdout.fileno()].append(_stream(1))
+            sinks[p.stderr.fileno()].append(_stream(2))
+        # (status, rusage, time) once the command has exited
+        ended = []
+        def exited(flags=os.WNOHANG):
+            while not ended:
+                try:
+                    pid, sts, ru = os.wait4(p.pid, flags)
+                except OSError as e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+                if pid:
+                    ended.append((sts, ru, time.time()))
+                break
+            return bool(ended)
+
+        interval = sample_interval()
+        if interval:
+            sampler = memory_sampler(p.pid, interval)
+            pump(sinks, sampler.sample, interval, exited)
+        else:
+            pump(sinks, exited=exited)
+        p.stdout.close()
+        p.stderr.close()
+
+        exited(0)
+        sts, ru, end = ended[0]
+        status = exit_status(sts)
+
+    out.close()
+    err.close()
+    info = {'return_code': status, 'start': start, 'end': end}
+    if ru is not None:
+        info['usage'] = usage(ru)
+        if sampler is not None:
+            info['usage']['peak_rss'] = sampler.peak
+    write_status(results_dir, info)
+    return status
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a job, recording its output and exit status')
+    parser.add_argument('--tee', action='store_true', help='also pass the output on')
+    parser.add_argument('results_dir')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    sys.exit(run(args.results_dir, args.command, args.tee))
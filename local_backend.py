@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 import os
+import errno
+import fcntl
+import select
+import signal
 import subprocess
-import dag, util
+import dag, util, job_wrapper
 import time
 import sys
 
@@ -21,11 +25,12 @@ class local_backend:
 
 
 	f.write(node.new_cmd + '\n')
-	f.write('echo $?\n')
 	f.close()
 
     def __init__(self):
-        pass
+        # read end of the pipe written to whenever a child exits; see
+        # watch_children
+        self.wakeup = None
 
     def run(self, node):
         
@@ -35,32 +40,84 @@ class local_backend:
         # Write bash script
 	filename=os.path.join(node.expdir, node.hsh+'.sh')
 	self.write_bash_script(filename, node, os.getcwd())
-        run_command = (filename + ' | tee %s/log 2>&1') % (node.exp_results)
-
-	os.system('chmod 700 '+filename)
+        os.chmod(filename, 0700)
 
         # run the experiment
         print 'Running command ' + node.new_cmd + ' in directory ' + os.getcwd()
         
-        node.jobid = subprocess.Popen(run_command, shell=True)
+        # the wrapper writes the output and exit status to the results
+        # directory
+        node.jobid = subprocess.Popen([sys.executable, job_wrapper.SCRIPT, '--tee',
+                                       node.exp_results, filename])
         return node.jobid
 
+    def watch_children(self):
+        """Have a byte written to self.wakeup whenever a child exits"""
+        if self.wakeup is not None:
+            return
+        r, w = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        # restart other system calls rather than failing them with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(w)
+        self.wakeup = r
+
+    def wait(self, nodes, timeout=None):
+        """Block until one of the given running nodes exits, or for at most
+        timeout seconds. Only the jobs' own processes are waited for (with
+        Popen.poll), so other children of this process are left alone;
+        SIGCHLD wakes us up when any child exits."""
+        procs = [n.jobid for n in nodes
+                 if n.jobid is not None and n.jobid.returncode is None]
+        if not procs:
+            return
+        self.watch_children()
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+        remaining = timeout
+        while True:
+            # empty the pipe before polling, so that a job exiting after
+            # it has been polled still wakes us up
+            try:
+                while os.read(self.wakeup, 4096):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+            if any(p.poll() is not None for p in procs):
+                return
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+            try:
+                select.select([self.wakeup], [], [], remaining)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
     def get_state(self, node):
         if node.info['run_state'] != dag.RUN_STATE_RUNNING:
-            return node.info['run_state']
+            return node.info['run_state'], node.info['return_code']
         else:
             return_code = node.jobid.poll()
 
             if return_code is None:
                 return dag.RUN_STATE_RUNNING, return_code
 
-            logfile=os.path.join(node.exp_results, 'log')
-            with open(logfile) as f:
-		status=int(list(f)[-1])
+            info = job_wrapper.read_status(node.exp_results)
+            if info is None:
+                print "Command '%s' was killed (status %d)" \
+                    % (node.new_cmd, return_code)
+                return dag.RUN_STATE_FAIL, return_code
+            status = info['return_code']
             if status == 0:
                 print "Command '%s' exited with status %d." \
                     % (node.new_cmd, status)
-                node.info['date_end'] = time.time()
+                node.info['date_end'] = info['end']
                 return dag.RUN_STATE_SUCCESS, status            
             else:
                 print "Command '%s' exited with status %d" \
@@ -12,10 +12,16 @@
 #\tparam1=?, param2=?, (optional)
 #\tparam3=?, param4=? (optional)
 #\tDependency1, Dependency2 (optional)
+#\tresources: cores=4, memory=2G, exclusive (optional)
+
+#Parameter values can be numbers, strings in quotation marks, True, False,
+#None, lists of these, range(...) and [x for x in <list or range>]. They
+#are parsed, not evaluated. Dependencies are listed between braces, e.g.
+#\t{"A", "B"[all], param}
 
 #Dependencies can be one of the following:
 #1. "A" - where A is the description of a previously defined experiement. The current experiment depends on A
-#2. "A" {all} - again A is the description of another experiement. The current experiment depends on
+#2. "A"[all] - again A is the description of another experiement. The current experiment depends on
 #               all possible ways of runnning A, for all parameters.
 #3. param - The current experiment might have a dependency that is variable and is provided as a parameter.
 #           In this case there should be a parameter which is named param which corresponds to a string that
@@ -26,279 +32,347 @@
 #seperate different values for that parameter. There is a case where the
 #parameter is actually supposed to be a list. This will case problems.
 
-from sets import Set
 import argparse
-import copy
+import itertools
 import shutil
 import os
+import re
 import exp_common
 
-import util, dag, local_backend
+import util, dag, backends, serialize, timeline
+
+
+class task_file_error(Exception):
+    """An error in a task file, with the position it was found at"""
+
+    def __init__(self, msg, filename, line, col=None):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.filename = filename
+        self.line = line
+        self.col = col
+
+    def __str__(self):
+        if self.col is None:
+            return 'Error in line {} of {}: {}'.format(self.line, self.filename, self.msg)
+        return 'Error in line {}, column {} of {}: {}'.format(self.line, self.col, self.filename, self.msg)
+
+class task_entry:
+    """One experiment (or sweep of experiments) described in a task file"""
+
+    def __init__(self, command, line):
+        self.command = command
+        self.description = None
+        self.commit = 'HEAD'
+        self.params = {}
+        # (description, all) pairs, in the order they were given
+        self.deps = []
+        self.resources = None
+        self.line = line
+
+class task_plan:
+    """The parsed contents of a task file: its entries, in order"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = []
+
+    def descriptions(self):
+        return set(e.description for e in self.entries)
+
+# Tokens in parameter and dependency lines. Values are parsed from these
+# tokens rather than evaluated, so a task file can't run arbitrary code.
+_TOKEN_RE = re.compile(r'''
+    [ \t]*(?:
+      (?P<num>-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)
+    | (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op>[\[\](),={}])
+    | (?P<bad>\S)
+    )''', re.VERBOSE)
+
+_TOKEN_KINDS = [None, 'num', 'str', 'name', 'op', 'bad']
+
+_CONSTANTS = {'True': True, 'False': False, 'None': None}
+
+class _line_parser:
+    """Recursive descent parser over the tokens of one line"""
+
+    def __init__(self, text, filename, line_no, start):
+        self.filename = filename
+        self.line_no = line_no
+
+        text = text.rstrip()
+        self.tokens = [(_TOKEN_KINDS[m.lastindex], m.group(m.lastindex), m.start(m.lastindex) + 1)
+                       for m in _TOKEN_RE.finditer(text, start)]
+        for token in self.tokens:
+            if token[0] == 'bad':
+                raise task_file_error('unexpected character {!r}'.format(token[1]),
+                                      filename, line_no, token[2])
+        # a sentinel, so there is always a next token
+        self.tokens.append(('end', '', len(text) + 1))
+        self.pos = 0
+
+    def error(self, msg, token=None):
+        if token is None:
+            token = self.peek()
+        return task_file_error(msg, self.filename, self.line_no, token[2])
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        if token[0] != 'end':
+            self.pos += 1
+        return token
+
+    def accept(self, value):
+        token = self.tokens[self.pos]
+        if token[1] == value and token[0] in ('op', 'name'):
+            self.pos += 1
+            return token
+        return None
+
+    def expect(self, value):
+        token = self.next()
+        if token[1] != value or token[0] not in ('op', 'name'):
+            raise self.error('expected \'{}\''.format(value), token)
+        return token
+
+    def expect_name(self):
+        token = self.next()
+        if token[0] != 'name':
+            raise self.error('expected a name', token)
+        return token[1]
+
+    def at_end(self):
+        return self.peek()[0] == 'end'
+
+    def value(self):
+        """number | string | True | False | None | list | range(...)"""
+        token = self.next()
+        kind, text = token[0], token[1]
+        if kind == 'num':
+            if re.match(r'-?\d+$', text):
+                return int(text)
+            return float(text)
+        elif kind == 'str':
+            return text[1:-1].decode('string_escape')
+        elif kind == 'name' and text in _CONSTANTS:
+            return _CONSTANTS[text]
+        elif kind == 'name' and text == 'range':
+            return self.range_call()
+        elif text == '[':
+            return self.list_value()
+        raise self.error('expected a value', token)
+
+    def range_call(self):
+        self.expect('(')
+        args = [self.value()]
+        while self.accept(','):
+            args.append(self.value())
+        self.expect(')')
+        if not 1 <= len(args) <= 3 or not all(isinstance(a, (int, long)) for a in args):
+            raise self.error('range takes one to three integers')
+        return range(*args)
+
+    def list_value(self):
+        """[v, ...], or [x for x in <list or range>]; the opening bracket has
+        already been read"""
+        items = []
+        if self.accept(']'):
+            return items
+
+        # comprehensions over a list or range, e.g. [x for x in range(1,3)]
+        if self.peek()[0] == 'name' and self.tokens[self.pos + 1][1] == 'for':
+            var = self.expect_name()
+            self.expect('for')
+            token = self.peek()
+            if self.expect_name() != var:
+                raise self.error('only comprehensions of the form [x for x in ...] are supported', token)
+            self.expect('in')
+            iterable = self.value()
+            if not isinstance(iterable, list):
+                raise self.error('can only iterate over a list or range')
+            self.expect(']')
+            return iterable
 
-nodes = {}
+        items.append(self.value())
+        while self.accept(','):
+            if self.peek()[1] == ']':
+                break
+            items.append(self.value())
+        self.expect(']')
+        return items
 
+    def assignments(self, params):
+        """name = value, name = value, ..."""
+        while True:
+            name = self.expect_name()
+            self.expect('=')
+            params[name] = self.value()
+            if not self.accept(','):
+                break
+            if self.at_end():
+                # trailing comma
+                break
+        if not self.at_end():
+            raise self.error('expected \',\' between parameters')
 
+    def dependencies(self):
+        """{"descr", "descr"[all], param, ...}"""
+        deps = []
+        self.expect('{')
+        while True:
+            token = self.next()
+            if token[0] not in ('str', 'name'):
+                raise self.error('dependencies should be either descriptions of other experiments enclosed in quotation marks or names of string parameters defined for this experiment', token)
+            all = False
+            if self.accept('['):
+                self.expect('all')
+                self.expect(']')
+                all = True
+            deps.append((token, all))
+            if not self.accept(','):
+                break
+        self.expect('}')
+        if not self.at_end():
+            raise self.error('unexpected text after dependencies')
+        return deps
 
-def parse_file(filename):
-    f = open(filename, 'r');
-    state = 'start' 
-                        
-    #nodes is a dictionary mapping descriptions to dag_node objects.
-    count = 0;
-    for line in f:
-        count = count+1
-        if line.strip() == '':
+def parse_string(text, filename='<string>'):
+    """Parse the contents of a task file into a task_plan, raising
+    task_file_error if they are malformed"""
+    plan = task_plan(filename)
+    defined = set()
+    entry = None
+
+    def finish(entry):
+        if entry is not None:
+            if entry.description is None:
+                raise task_file_error('the command has no description', filename, entry.line)
+            defined.add(entry.description)
+            plan.entries.append(entry)
+
+    for line_no, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        # skip blank lines and treat lines starting with '#' as comments
+        if not stripped or stripped[0] == '#':
             continue
 
-        # treat lines starting with '#' as comments
-        if line.strip()[0] == '#':
+        if line[0] != '\t':
+            # a new command
+            finish(entry)
+            entry = task_entry(stripped, line_no)
             continue
 
-        if state == 'start':
-            #This will only be executed once 
-            command = line.strip()
-            commit = 'HEAD' #default
-            state = 'description'
-            parameters = {}
-            dependencies = Set()
-           # print("command = " + command)
-
-        elif state == 'description':
-            #Reach this point because this line should be the description line
-            #Check for tab then "
-            if line[0:2] != '\t"':
-                print('Error in line ' + str(count) + ' of ' + args.file + ': The first line after each command should start with a tab, followed by the description for the experiment, enclosed in double quotation marks.')
-                exit(-1);
-            desc = line[2:line.find('"', 2)].strip()
-            state = 'commit'
-          #  print("desc = " + desc)
-            
-        #Commit is optional
-        elif state == 'commit' and line[0:1] == '\t' and line.find('=') == -1 and line[1] != '{':
-            commit = line[1:line.find('\n',1)]
-          #  print("commit = " + commit)
+        if entry is None:
+            raise task_file_error('expected a command before indented lines', filename, line_no, 1)
 
-        else:
-            #Reach this point if the line specifies parameters, dependencies or we have reached a new command
-            #Check for tab, if no tab then the experiement description is finished.
-            if line[0:1] != '\t':
-                #print("Finish " + command)
-                check_dependencies(parameters,desc,commit, command,None,dependencies)
-                command = line.strip()
-                commit = 'HEAD' #default
-                state = 'description'
-                parameters = {}
-                dependencies = Set()
-           #     print("command = " + command)  
-            else:
-                #Check if there are any parameters specified
-                if line.find('=') != -1:
-                    index = 1
-                    while line.find('=', index) != -1:
-                        pos = line.find('=', index)
-                        comma = line.find(',', pos)#This will work for numbers and strings without commas
-                        if comma != -1:
-                            
-                            if '[' in line[pos:comma]:#line.find('[', pos,comma):#Deal with lists
-                                openBracket = line.find('[', pos,comma)
-                                closeBracket = line.find(']', openBracket+1)
-                                comma = line.find(',', closeBracket)
-                                if(comma==-1):
-                                    comma=closeBracket+1
-                            parameters[line[index:pos].strip()] = eval(line[pos+1:comma])
-                            
-                            index = comma+1
-                        else:
-                            newline = line.find('\n', pos)
-                            parameters[line[index:pos].strip()] = eval(line[pos+1:newline])
-                            break
-                    #print parameters
+        if entry.description is None:
+            if line[0:2] != '\t"' or line.find('"', 2) == -1:
+                raise task_file_error('The first line after each command should start with a tab, followed by the description for the experiment, enclosed in double quotation marks.', filename, line_no, 2)
+            entry.description = line[2:line.find('"', 2)].strip()
+
+        elif line.startswith('\tresources:'):
+            # resource requests are not part of the experiment
+            try:
+                entry.resources = util.parse_resources(line[len('\tresources:'):])
+            except ValueError as e:
+                raise task_file_error(str(e), filename, line_no, len('\tresources:') + 1)
+
+        elif stripped[0] == '{':
+            p = _line_parser(line, filename, line_no, line.index('{'))
+            for token, all in p.dependencies():
+                if token[0] == 'str':
+                    d = token[1][1:-1].decode('string_escape').strip()
                 else:
-                    #print("dependency stage")
-                    #Check for tab, if no tab then the experiement description is finished.
-                    if line[0:1] != '\t':
-                   #     print("Finish " + command)
-                        check_dependencies(parameters,desc,commit, command,None,dependencies)
-                        command = line.strip()
-                        commit = 'HEAD' #default
-                        state = 'description'
-                        parameters = {}
-                        dependencies = Set()
-                    #    print("command = " + command)  
-                    else:
-                        index = 2
-                        pos = line.find(',', index)
-                        if pos == -1:
-                            pos = line.find('}', index)
-                        
-                        while pos != -1:
-                            if line.find('[all]',index,pos) != -1:
-                                pos = pos - 5
-                                all = True
-                            else:
-                                all = False
-                            #print(line[index:pos])
-                            #print("index = " + str(index))
-                            #print("pos = " + str(pos))
-                            if line.find('"', index, pos) != -1:
-                                startQuote = line.find('"', index)
-                                d = eval(line[startQuote:pos]).strip()
-                                if d in nodes:
-                                    dependencies.add((d,all))
-                                else:
-                                    print('Error in line ' + str(count) + ' of ' + args.file + ':All dependencies must have been previously definied.')
-                                    exit(-1)
-                            else:                                    
-                                param = line[index:pos]
-                                #print(index)
-                                #print(pos)
-                                #print(param)
-                                if param in parameters and isinstance(parameters[param],str):
-                                    d = parameters[param]
-                                    if d in nodes:
-                                        dependencies.add((d,all))
-                                    else:
-                                        print('Error in line ' + str(count) + ' of ' + args.file + ': All dependencies must have been previously definied.')
-                                        exit(-1)
-                                else:
-                                    print('Error in line ' + str(count) + ' of ' + args.file + '(' + line + '): Dependencies should be either descriptions of other experiments enclosed in quotation marks or names of string parameters defined for this experiment.\n')
-                                    exit(-1)
-                            if line[pos] == '}' or (all and line[pos+5] == '}'):
-                                break
-                            index = pos+1
-                            if all:
-                                index = index+5
-                            pos = line.find(',', index)
-                            if pos == -1:
-                                pos = line.find('}', index)
-   # print("Finish " + command + " (desc = " + desc + ") dependencies = ")
-   # print dependencies
-    check_dependencies(parameters,desc,commit, command,None,dependencies)
+                    # a parameter naming the experiment
+                    d = entry.params.get(token[1])
+                    if not isinstance(d, str):
+                        raise task_file_error('dependency \'{}\' is neither a quoted description nor a string parameter of this experiment'.format(token[1]), filename, line_no, token[2])
+                if d not in defined:
+                    raise task_file_error('All dependencies must have been previously defined (\'{}\' is not).'.format(d), filename, line_no, token[2])
+                if (d, all) not in entry.deps:
+                    entry.deps.append((d, all))
+
+        elif '=' in line:
+            _line_parser(line, filename, line_no, 1).assignments(entry.params)
 
-    
-def printDag():
-    print("The following is the structure of the dag...")
-    for nodeGroup in nodes:
-        print("Description = " + nodeGroup)
-        for node in nodes[nodeGroup]:
-            print("\tAddress = ")
-            print(node)
-            print("\tCommit = " + node.commit)
-            print("\tCommand = " + node.command)
-            print("\tParams = ")
-            print(node.params)
-            print("\tParents = ")
-            print(node.parents)
-            
-       
-
-#Need to check if any of the dependencies are to experiements that were run for a list of parameter values
-def check_dependencies(parameters,desc,commit,command,dependencies,dependencies_to_search):
-    if len(dependencies_to_search) == 0:
-        #print("Calling check_parameters parameters = ")
-        #print parameters
-        #print("dependencies = ")
-        #print dependencies
-        check_parameters({},parameters,desc,commit,command,dependencies)
-        return
-    this_dependencies_to_search = dependencies_to_search.copy()
-    (dep,all) = this_dependencies_to_search.pop()
-    if dependencies == None:
-        this_dependencies = Set()
-    else:
-        this_dependencies = dependencies.copy()
-    if len(nodes[dep]) == 1: #all=True here doens't make sense so don't check for it
-        #Don't need to worry about creating multiple nodes for this dependency
-        #Add the actual node, not just name
-        for d in  nodes[dep]:
-            this_dependencies.add(d)
-        check_dependencies(parameters, desc, commit, command, this_dependencies, this_dependencies_to_search)
-    else:
-        if all:
-          #  print("Consolidating becaues of an 'all'")
-           # print(nodes[dep])
-            this_dependencies = this_dependencies.union(nodes[dep])
-           # print this_dependencies
-            check_dependencies(parameters,desc,commit,command, this_dependencies, this_dependencies_to_search)
-        else:
-            for d in nodes[dep]:
-                this_dependencies.add(d)
-                check_dependencies(parameters,desc,commit,command, this_dependencies,this_dependencies_to_search)
-                this_dependencies.remove(d)
-
-def check_parameters(parameters_searched, parameters_to_search, desc, commit, command, dependencies):
-    this_parameters_to_search = copy.deepcopy(parameters_to_search)
-    if len(parameters_to_search) != 0:
-        #cur_params_searched = parameters_searched.copy()
-        #cur_params_to_search = parameters_to_search.copy()
-        #for key in parameters_to_search:
-        (key,value) = this_parameters_to_search.popitem()
-        if isinstance(value, list):
-            #Need to create at least one node for each element in list. May have to create more if other
-            #parameters are also lists.
-            #print("value")
-            #print(value)
-            for l in value:
-                #print("l = " + str(l))
-                this_parameters_searched = copy.deepcopy(parameters_searched)
-                this_parameters_searched[key] = l
-                #print cur_params_searched
-                #print cur_params_to_search
-                check_parameters(this_parameters_searched, this_parameters_to_search, desc,commit,command,dependencies)
-        else:
-            this_parameters_searched = copy.deepcopy(parameters_searched)
-            this_parameters_searched[key] = value
-            check_parameters(this_parameters_searched, this_parameters_to_search, desc,commit,command,dependencies)
-    else:
-     #   print("ready to make node, parameters = ")
-     #   print(parameters_searched)
-        
-        #if command starts with @, it is a macro
-        if(command[0]=='@'):
-            code=command[1:]
-            newNode = dag.dag_node(desc,parameters_searched,commit,None, code, dependencies)
         else:
-            newNode = dag.dag_node(desc,parameters_searched,commit,command, None, dependencies)
-    #    print("newNode = " )
-    #    print newNode
-    #    print("parameters = ")
-    #    print(newNode.params)
-        if desc in nodes:
-            nodes[desc].add(newNode)
+            entry.commit = stripped
+
+    finish(entry)
+    return plan
+
+def parse_task_file(filename):
+    """Parse a task file into a task_plan"""
+    with open(filename) as f:
+        return parse_string(f.read(), filename)
+
+def expand_entry(entry, nodes, commit='HEAD'):
+    """Generate the dag_nodes for one entry: one for each combination of
+    the values of list-valued parameters and of the nodes of each
+    dependency with several nodes (unless it is depended on with [all]).
+    nodes maps the descriptions of earlier entries to their nodes."""
+    if entry.commit != 'HEAD':
+        commit = entry.commit
+
+    # each dependency contributes a choice of sets of parents
+    dep_choices = []
+    for d, all in entry.deps:
+        if all or len(nodes.get(d, ())) == 1:
+            dep_choices.append([nodes.get(d, [])])
         else:
-            nodes[desc] = Set()
-            nodes[desc].add(newNode)
-        #Add to all nodes in dependencies that they have a child nodes[desc]
-        #print("dependencies = ")
-        #print dependencies
-        newNodeSet = Set()
-        newNodeSet.add(newNode)
-        if dependencies != None:
-            for d in dependencies:
-                d.add_children(newNodeSet)
- 
+            dep_choices.append([[n] for n in nodes.get(d, ())])
+
+    keys = sorted(entry.params)
+    values = [entry.params[k] if isinstance(entry.params[k], list) else [entry.params[k]]
+              for k in keys]
+
+    for parents in itertools.product(*dep_choices):
+        for combination in itertools.product(*values):
+            params = dict(zip(keys, combination))
+            #if command starts with @, it is a macro
+            if entry.command[0] == '@':
+                node = dag.dag_node(entry.description, params, commit, None, entry.command[1:], resources=entry.resources)
+            else:
+                node = dag.dag_node(entry.description, params, commit, entry.command, None, resources=entry.resources)
+            node.add_parents(set(itertools.chain.from_iterable(parents)))
+            yield node
+
+def expand_plan(plan, commit='HEAD'):
+    """Generate the dag_nodes for all the experiments in plan, parents
+    before children. The nodes of an entry are only kept around until the
+    last entry that depends on it has been expanded."""
+    last_use = {}
+    for i, entry in enumerate(plan.entries):
+        for d, all in entry.deps:
+            last_use[d] = i
+    nodes = {}
+    for i, entry in enumerate(plan.entries):
+        for node in expand_entry(entry, nodes, commit):
+            if last_use.get(entry.description, -1) > i:
+                nodes.setdefault(entry.description, []).append(node)
+            yield node
+        for d, all in entry.deps:
+            if last_use[d] == i:
+                nodes.pop(d, None)
 
 
 ###### Functions to save the 'task'
 
-# Functions to fill in a 'HEAD' commit in all nodes    
-def fill_in_commit(new_commit):
-    for nodeGroup in nodes:
-        for node in nodes[nodeGroup]:
-             if(node.commit=='HEAD'):
-                 node.commit=new_commit
-
-# Run a dag
-def run():
-    toplevel_nodes = []
-    for nodeGroup in nodes:
-        for node in nodes[nodeGroup]:
-            if not node.parents:
-                toplevel_nodes += [node]
-
-    mydag = dag.dag(toplevel_nodes)
-    mydag.backend = local_backend.local_backend()
+# Run a dag. Nodes are created as the scheduler needs them.
+def run(plan, commit, max_cores=None, max_memory=None, backend=None, trace=None):
+    backend = backends.make_backend(backend)
+    budget = backends.resource_budget(backend, max_cores, max_memory)
+    mydag = dag.dag([], backend, budget, pending=expand_plan(plan, commit))
+    if trace is not None:
+        mydag.timeline = []
     status = mydag.mainloop()
+    if trace is not None:
+        timeline.write_trace(trace, mydag.timeline, mydag.budget['cores'])
     if status == dag.RUN_STATE_SUCCESS:
         print "Task completed successfully."
     elif status == dag.RUN_STATE_FAIL:
@@ -347,29 +421,36 @@ def load_task(task_id):
     except:
         print 'Could not access task file {}'.format(taskfilename)
         exit(1)
-    task_namespace=eval(f.read())
+    task_namespace=serialize.loads_repr(f.read())
     return (task_namespace['filename'], task_namespace['commit'])
 
+# Parse a file for one of the commands below, exiting on errors
+def parse_file_or_exit(filename):
+    try:
+        return parse_task_file(filename)
+    except task_file_error as e:
+        print e
+        exit(-1)
+    except IOError as e:
+        print 'Could not read task file {}: {}'.format(filename, e.strerror)
+        exit(-1)
+
 # Run a file
 def run_file(args):
     filename=args.file
     
     #Parse the file 
-    parse_file(filename)
+    plan=parse_file_or_exit(filename)
     
-    # Get the current commit hash
-    commit=util.exec_output(['git', 'rev-parse', 'HEAD']).strip()
-    
-    # Fill in this commit wherever HEAD occurs
-    
-    fill_in_commit(commit)
+    # Get the current commit hash, which is used wherever HEAD occurs
+    commit=util.rev_parse('HEAD')
    
     # Create a new task
     task_id=save_task(filename, commit)
     print 'The id for this task is {}'.format(str(task_id))
    
     # Start running
-    run()
+    run(plan, commit, args.max_cores, args.max_memory, args.backend, args.trace)
 
 # Run an old task
 def run_old_task(args):
@@ -379,11 +460,9 @@ def run_old_task(args):
     (filename, commit)=load_task(task_id)
     
     # Parse the file
-    parse_file(filename)
+    plan=parse_file_or_exit(filename)
     
-    #Fill in commit
-    fill_in_commit(commit)
-    run()
+    run(plan, commit, args.max_cores, args.max_memory, args.backend, args.trace)
 
     
 if __name__ == '__main__':
@@ -397,6 +476,12 @@ if __name__ == '__main__':
     runtask = subparsers.add_parser('runtask', help='run all the experiements from an old task')
     runtask.add_argument('taskid', help='id of the task')
     runtask.set_defaults(func=run_old_task)
+
+    for p in (runfile, runtask):
+        p.add_argument('--max-cores', type=int, help='cores available for running experiments (default: all the backend has)')
+        p.add_argument('--max-memory', help='memory available for running experiments, e.g. 16G (default: all)')
+        backends.add_argument(p)
+        p.add_argument('--trace', help='write a Chrome trace of the run to this file')
     
     args = parser.parse_args()
     args.func(args)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import errno
+import fcntl
+import select
+import signal
+import socket
+import subprocess
+import time
+import argparse
+import multiprocessing
+
+import dag, job_wrapper
+
+# remote_backend.py: a backend handing jobs to worker agents, which may be
+# on other machines.
+#
+# A worker (this file, run with --worker) runs the commands it is sent
+# and reports back when each one exits. Workers are named in the
+# EXP_WORKERS environment variable, a comma separated list of
+#
+#   local[:slots]          a worker started on this machine, over a pipe
+#   ssh:host[:slots]       a worker started on host with ssh, over a pipe
+#   unix:path              a worker already listening on a Unix socket
+#                          (remote_backend.py --worker --listen path)
+#
+# (default: local). Other transports only need to provide a pair of file
+# descriptors; see TRANSPORTS. The results directory, and so the
+# repository, must be at the same path on all machines, e.g. on a shared
+# filesystem.
+#
+# Messages are JSON objects, one per line. The scheduler sends
+# {"type": "run", ...}; workers send "hello" (with their number of slots)
+# when they connect, "exit" when a job exits, and a "heartbeat" every
+# HEARTBEAT_INTERVAL seconds. A worker that hasn't been heard from for
+# HEARTBEAT_TIMEOUT seconds is considered lost, and so are the jobs it was
+# running. Jobs are queued here until some worker has enough free slots
+# (one per core the job asks for). Unless --max-cores is given, the
+# scheduler's budget is the slots of all the workers (see budget).
+#
+# A worker listening on a socket serves one scheduler at a time. The jobs
+# of a scheduler that goes away keep running, and until they have all
+# exited, the worker turns other schedulers away ("busy") rather than
+# take on more jobs than it has slots.
+
+HEARTBEAT_INTERVAL = 5
+HEARTBEAT_TIMEOUT = 30
+
+DEFAULT_WORKERS = 'local'
+
+WORKER_SCRIPT = os.path.abspath(__file__).replace('.pyc', '.py')
+
+class channel:
+    """Newline-delimited JSON messages over a pair of file descriptors"""
+
+    def __init__(self, rfd, wfd, name, owner=None):
+        self.rfd = rfd
+        self.wfd = wfd
+        self.name = name
+        # the process or socket the descriptors belong to
+        self.owner = owner
+        self.buf = ''
+
+    def fileno(self):
+        return self.rfd
+
+    def send(self, msg):
+        data = json.dumps(msg) + '\n'
+        while data:
+            data = data[os.write(self.wfd, data):]
+
+    def receive(self):
+        """The messages that have arrived, or None at end of file. Only call
+        when the descriptor is readable."""
+        data = os.read(self.rfd, 65536)
+        if not data:
+            return None
+        self.buf += data
+        lines = self.buf.split('\n')
+        self.buf = lines.pop()
+        return [json.loads(l) for l in lines if l]
+
+    def close(self):
+        if isinstance(self.owner, subprocess.Popen):
+            self.owner.stdin.close()
+            self.owner.stdout.close()
+        elif self.owner is not None:
+            self.owner.close()
+
+
+# Transports: each takes the rest of a worker spec and returns a channel
+
+def _spawn(argv, name):
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         close_fds=True)
+    return channel(p.stdout.fileno(), p.stdin.fileno(), name, p)
+
+def local_transport(args):
+    argv = [sys.executable, WORKER_SCRIPT, '--worker']
+    if args:
+        argv += ['--slots', args[0]]
+    return _spawn(argv, 'local')
+
+def ssh_transport(args):
+    host = args[0]
+    argv = ['ssh', '-T', host, 'python', WORKER_SCRIPT, '--worker']
+    if len(args) > 1:
+        argv += ['--slots', args[1]]
+    return _spawn(argv, host)
+
+def unix_transport(args):
+    path = ':'.join(args)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(path)
+    return channel(s.fileno(), s.fileno(), path, s)
+
+TRANSPORTS = {
+    'local': local_transport,
+    'ssh': ssh_transport,
+    'unix': unix_transport,
+}
+
+def connect(spec):
+    parts = spec.strip().split(':')
+    if parts[0] not in TRANSPORTS:
+        print 'Unknown worker transport {} in {}'.format(parts[0], spec)
+        exit(1)
+    try:
+        return TRANSPORTS[parts[0]](parts[1:])
+    except (OSError, socket.error) as e:
+        print 'Could not connect to worker {}: {}'.format(spec, e)
+        return None
+
+
+class worker_state:
+    def __init__(self, chan):
+        self.chan = chan
+        self.slots = None
+        self.used = 0
+        self.jobs = set()
+        self.last_seen = time.time()
+
+class remote_backend:
+
+    def __init__(self, specs=None):
+        if specs is None:
+            specs = os.environ.get('EXP_WORKERS', DEFAULT_WORKERS).split(',')
+        self.workers = []
+        for spec in specs:
+            chan = connect(spec)
+            if chan is not None:
+                self.workers.append(worker_state(chan))
+        if not self.workers:
+            print 'No workers to run jobs on'
+            exit(1)
+
+        self.next_id = 0
+        # nodes waiting for a free slot, in order
+        self.queue = []
+        # job id -> (worker, slots) of running jobs, and exit status (or
+        # None if lost) of finished ones
+        self.running = {}
+        self.results = {}
+
+        # wait for every worker to say how many slots it has
+        while any(w.slots is None for w in self.workers):
+            self.poll(HEARTBEAT_TIMEOUT)
+        if not self.workers:
+            exit(1)
+
+    def budget(self):
+        return {'cores': sum(w.slots for w in self.workers), 'memory': 0}
+
+    def run(self, node):
+        self.next_id += 1
+        node.jobid = self.next_id
+        self.queue.append(node)
+        self.dispatch()
+        return node.jobid
+
+    def dispatch(self):
+        """Send queued jobs to workers with free slots"""
+        queue = []
+        for node in self.queue:
+            for w in self.workers:
+                slots = min(node.resources['cores'], w.slots)
+                if w.used + slots <= w.slots:
+                    break
+            else:
+                queue.append(node)
+                continue
+
+            cwd = os.path.join(node.expdir, node.working_dir)
+            env = {'EXP_RESULTS_DIR': node.exp_results,
+                   'PATH': os.environ.get('PATH', '') + ':' + cwd}
+            if len(node.parents) == 1:
+                env['EXP_PARENT_RESULTS_DIR'] = list(node.parents)[0].exp_results
+            print 'Running command {} in directory {} on {}'.format(
+                node.new_cmd, cwd, w.chan.name)
+            try:
+                w.chan.send({'type': 'run', 'id': node.jobid,
+                             'cmd': node.new_cmd, 'cwd': cwd, 'env': env,
+                             'results': node.exp_results})
+            except OSError:
+                self.lost(w)
+                queue.append(node)
+                continue
+            w.used += slots
+            w.jobs.add(node.jobid)
+            self.running[node.jobid] = (w, slots)
+
+        if not self.workers:
+            # nowhere left to run them
+            for node in queue:
+                self.results[node.jobid] = None
+            queue = []
+        self.queue = queue
+
+    def lost(self, w):
+        print 'Lost worker {}'.format(w.chan.name)
+        for jobid in w.jobs:
+            self.running.pop(jobid, None)
+            self.results[jobid] = None
+        w.chan.close()
+        self.workers.remove(w)
+        if not self.workers:
+            print 'No workers left to run jobs on'
+
+    def poll(self, timeout):
+        """Handle the messages from workers, waiting up to timeout seconds
+        (None: indefinitely) for the first one"""
+        if not self.workers:
+            return
+        try:
+            ready = select.select([w.chan for w in self.workers], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        now = time.time()
+        for chan in ready:
+            w = [w for w in self.workers if w.chan is chan][0]
+            try:
+                msgs = chan.receive()
+            except (OSError, ValueError):
+                msgs = None
+            if msgs is None:
+                self.lost(w)
+                continue
+            w.last_seen = now
+            for msg in msgs:
+                if msg['type'] == 'hello':
+                    w.slots = msg['slots']
+                elif msg['type'] == 'busy':
+                    print 'Worker {} is still running {} jobs of another scheduler'.format(
+                        w.chan.name, msg['running'])
+                    self.lost(w)
+                    break
+                elif msg['type'] == 'exit':
+                    w.jobs.discard(msg['id'])
+                    w.used -= self.running.pop(msg['id'], (w, 0))[1]
+                    self.results[msg['id']] = msg['status']
+
+        for w in list(self.workers):
+            if now - w.last_seen > HEARTBEAT_TIMEOUT:
+                self.lost(w)
+
+        self.dispatch()
+
+    def wait(self, nodes, timeout=None):
+        if not any(n.jobid in self.results for n in nodes):
+            self.poll(timeout)
+
+    def get_state(self, node):
+        if node.info['run_state'] != dag.RUN_STATE_RUNNING:
+            return node.info['run_state'], node.info['return_code']
+
+        self.poll(0)
+        if node.jobid not in self.results:
+            return dag.RUN_STATE_RUNNING, None
+
+        status = self.results.pop(node.jobid)
+        if status is None:
+            print "Command '%s' was lost with its worker" % node.new_cmd
+            return dag.RUN_STATE_FAIL, None
+        print "Command '%s' exited with status %d." % (node.new_cmd, status)
+        info = job_wrapper.read_status(node.exp_results)
+        node.info['date_end'] = info['end'] if info else time.time()
+        if status == 0:
+            return dag.RUN_STATE_SUCCESS, status
+        return dag.RUN_STATE_FAIL, status
+
+
+# The worker
+
+def start_job(msg):
+    env = dict(os.environ)
+    env.update((k.encode('utf-8'), v.encode('utf-8'))
+               for k, v in msg['env'].iteritems())
+    # the wrapper saves the output and status in the results directory
+    with open(os.devnull, 'r+') as null:
+        return subprocess.Popen([sys.executable, job_wrapper.SCRIPT,
+                                 msg['results'].encode('utf-8'),
+                                 '/bin/bash', '-c', msg['cmd'].encode('utf-8')],
+                                cwd=msg['cwd'], env=env, stdin=null,
+                                stdout=null, stderr=null, close_fds=True)
+
+def serve(chan, slots, jobs):
+    """Run jobs for one scheduler until it disconnects. jobs maps job ids
+    to the Popen objects of running jobs."""
+    # wake up select when a job exits
+    rpipe, wpipe = os.pipe()
+    for fd in (rpipe, wpipe):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wpipe)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    chan.send({'type': 'hello', 'slots': slots, 'host': socket.gethostname()})
+    last_beat = time.time()
+    try:
+        while True:
+            try:
+                ready = select.select([chan, rpipe], [], [], HEARTBEAT_INTERVAL)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if rpipe in ready:
+                try:
+                    os.read(rpipe, 4096)
+                except OSError:
+                    pass
+            for jobid, p in jobs.items():
+                if p.poll() is not None:
+                    del jobs[jobid]
+                    status = p.returncode if p.returncode >= 0 else 128 - p.returncode
+                    chan.send({'type': 'exit', 'id': jobid, 'status': status})
+
+            if chan in ready:
+                msgs = chan.receive()
+                if msgs is None:
+                    return
+                for msg in msgs:
+                    if msg['type'] == 'run':
+                        try:
+                            jobs[msg['id']] = start_job(msg)
+                        except (OSError, IOError) as e:
+                            sys.stderr.write('worker: could not start {}: {}\n'
+                                             .format(msg['cmd'], e))
+                            chan.send({'type': 'exit', 'id': msg['id'], 'status': 127})
+
+            if time.time() - last_beat >= HEARTBEAT_INTERVAL:
+                chan.send({'type': 'heartbeat', 'running': jobs.keys()})
+                last_beat = time.time()
+    except OSError:
+        # the scheduler went away while we were writing
+        return
+    finally:
+        signal.set_wakeup_fd(-1)
+        os.close(rpipe)
+        os.close(wpipe)
+
+def worker(args):
+    slots = args.slots or multiprocessing.cpu_count()
+    if args.listen is None:
+        serve(channel(0, 1, 'scheduler'), slots, {})
+        return
+
+    # serve one scheduler after another. The jobs of one that goes away
+    # keep running, and no other scheduler is served until they have all
+    # exited: their slots are still taken, and nobody is left to report
+    # their exits to.
+    if os.path.exists(args.listen):
+        os.remove(args.listen)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(args.listen)
+    s.listen(1)
+    jobs = {}
+    while True:
+        try:
+            conn, addr = s.accept()
+        except socket.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        chan = channel(conn.fileno(), conn.fileno(), 'scheduler', conn)
+        for jobid, p in jobs.items():
+            if p.poll() is not None:
+                del jobs[jobid]
+        if jobs:
+            try:
+                chan.send({'type': 'busy', 'running': len(jobs)})
+            except OSError:
+                pass
+        else:
+            serve(chan, slots, jobs)
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run jobs for remote_backend')
+    parser.add_argument('--worker', action='store_true', required=True)
+    parser.add_argument('--slots', type=int, help='jobs to run at once (default: number of cores)')
+    parser.add_argument('--listen', help='serve schedulers connecting to this Unix socket instead of stdin/stdout')
+    worker(parser.parse_args())
@@ -5,7 +5,7 @@ import time
 # this file is just for testing; if a user actually wanted to run a
 # job they'd use exp.py.
 
-hsh = util.exec_output(['git', 'rev-parse', 'HEAD']).strip()
+hsh = util.rev_parse('HEAD')
 
 test_node = dag.dag_node(desc = "testscript", commit = hsh, command = "./test.sh")
 test_node2=dag.dag_node(desc = "testscript2", commit = hsh, command = "./test2.sh {testscript}/log")
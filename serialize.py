@@ -0,0 +1,129 @@
+import ast
+import json
+
+# serialize.py: reading and writing experiment info.
+#
+# Current descr files start with a version line, followed by one field
+# per line: the field name, a tab, and the value as JSON. Sets, tuples and
+# dictionaries with non-string keys, which JSON doesn't have, are written
+# as single-key objects ({"__set__": [...]} etc.); values JSON can't
+# represent at all are written as their repr ({"__repr__": "..."}) and
+# read back as that string. Since each field is on its own line, reading
+# a few fields doesn't require decoding the whole record.
+#
+# Files written by older versions contain the repr of the info
+# dictionary. These are still read, without eval, as long as they only
+# contain literals and sets.
+
+FORMAT_VERSION = 2
+HEADER = 'exp-descr {}'.format(FORMAT_VERSION)
+
+def _encode(obj):
+    """Convert obj into something json can write"""
+    if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+        return obj
+    elif isinstance(obj, list):
+        return [_encode(x) for x in obj]
+    elif isinstance(obj, tuple):
+        return {'__tuple__': [_encode(x) for x in obj]}
+    elif isinstance(obj, (set, frozenset)):
+        return {'__set__': [_encode(x) for x in sorted(obj)]}
+    elif isinstance(obj, dict):
+        if all(isinstance(k, basestring) for k in obj):
+            return dict((k, _encode(v)) for k, v in obj.iteritems())
+        return {'__dict__': [[_encode(k), _encode(v)]
+                             for k, v in obj.iteritems()]}
+    else:
+        return {'__repr__': repr(obj)}
+
+def _decode(obj):
+    """Inverse of _encode, applied to the output of json.loads. Strings are
+    returned as str rather than unicode, like the rest of this code
+    expects."""
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [_decode(x) for x in obj]
+    elif isinstance(obj, dict):
+        if len(obj) == 1:
+            k, v = obj.items()[0]
+            if k == '__set__':
+                return set(_decode(x) for x in v)
+            elif k == '__tuple__':
+                return tuple(_decode(x) for x in v)
+            elif k == '__dict__':
+                return dict((_decode(x), _decode(y)) for x, y in v)
+            elif k == '__repr__':
+                return _decode(v)
+        return dict((k.encode('utf-8'), _decode(v)) for k, v in obj.iteritems())
+    return obj
+
+def dumps_value(obj):
+    return json.dumps(_encode(obj), sort_keys=True)
+
+def loads_value(s):
+    return _decode(json.loads(s))
+
+def dumps(info):
+    """Serialize an info dictionary"""
+    lines = [HEADER]
+    for k in sorted(info):
+        lines.append('{}\t{}'.format(k, dumps_value(info[k])))
+    return '\n'.join(lines) + '\n'
+
+def _literal(node):
+    """Evaluate a node of a parsed repr: literals, containers, and calls to
+    set(), which is how Python 2 writes sets"""
+    if isinstance(node, ast.Expression):
+        return _literal(node.body)
+    elif isinstance(node, ast.Str):
+        return node.s
+    elif isinstance(node, ast.Num):
+        return node.n
+    elif isinstance(node, ast.Name):
+        if node.id in ('None', 'True', 'False'):
+            return {'None': None, 'True': True, 'False': False}[node.id]
+        if node.id in ('inf', 'nan'):
+            return float(node.id)
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = _literal(node.operand)
+        return -value if isinstance(node.op, ast.USub) else value
+    elif isinstance(node, ast.List):
+        return [_literal(x) for x in node.elts]
+    elif isinstance(node, ast.Tuple):
+        return tuple(_literal(x) for x in node.elts)
+    elif isinstance(node, ast.Set):
+        return set(_literal(x) for x in node.elts)
+    elif isinstance(node, ast.Dict):
+        return dict((_literal(k), _literal(v))
+                    for k, v in zip(node.keys, node.values))
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and
+          node.func.id in ('set', 'frozenset') and not node.keywords and
+          len(node.args) <= 1):
+        return set(_literal(node.args[0])) if node.args else set()
+    raise ValueError('not a literal: {}'.format(ast.dump(node)))
+
+def loads_repr(s):
+    """Read info written as a repr by older versions"""
+    return _literal(ast.parse(s.strip(), mode='eval'))
+
+def is_current(s):
+    return s.startswith(HEADER + '\n')
+
+def loads(s, fields=None):
+    """Read an info dictionary written by dumps (or by older versions). If
+    fields is given, only those fields are decoded."""
+    if not is_current(s):
+        info = loads_repr(s)
+        if fields is not None:
+            info = dict((k, v) for k, v in info.iteritems() if k in fields)
+        return info
+
+    info = {}
+    for line in s.split('\n')[1:]:
+        if not line:
+            continue
+        k, v = line.split('\t', 1)
+        if fields is None or k in fields:
+            info[k] = loads_value(v)
+    return info
@@ -1,6 +1,12 @@
 import dag
 import os
 import csv
+from multiprocessing.pool import ThreadPool
+
+# Parents' output files are read by this many threads at once (or
+# EXP_MACRO_THREADS), so that gathering the results of a large sweep is
+# limited by the filesystem rather than done one file after another.
+READ_THREADS = 16
 
 #List of macros
 macro_list=['produce_output_list_macro', 'produce_annotated_list_macro', 'produce_parameter_map_macro', 'produce_all_map_macro', 'compute_percentiles_macro']
@@ -23,6 +29,39 @@ def produce_annotated_list_macro(node, param_name):
             f.write(str(x.params[param_name])+' : '+x.exp_results)
             f.write('\n')
 
+def read_threads():
+    try:
+        return max(1, int(os.environ['EXP_MACRO_THREADS']))
+    except (KeyError, ValueError):
+        return READ_THREADS
+
+def first_lines(parents, filename, kind):
+    """Yield (parent, first line of its file filename) for each parent, in
+    order. The files are read concurrently, and only as far as the end of
+    their first line. kind is what the file is called in errors."""
+    parents = list(parents)
+
+    def read(x):
+        try:
+            with open(os.path.join(x.exp_results, filename)) as fi:
+                return x, fi.readline()
+        except IOError:
+            return x, None
+
+    pool = ThreadPool(min(read_threads(), max(len(parents), 1)))
+    try:
+        chunksize = max(1, len(parents) // (4 * read_threads()))
+        for x, line in pool.imap(read, parents, chunksize):
+            if line is None:
+                print "Error: could not open %s file '%s' from job '%s'" % (kind, os.path.join(x.exp_results, filename), x.info['description'])
+                exit(1)
+            if not line:
+                print "Error: empty %s file '%s' from job '%s'" % (kind, os.path.join(x.exp_results, filename), x.info['description'])
+                exit(1)
+            yield x, line.strip()
+    finally:
+        pool.terminate()
+
 # This macro assumes that each parent job has written its output
 # (typically a single number, or multiple numbers separated by spaces)
 # to the first line of a file "out" in its results directory. 
@@ -31,14 +70,7 @@ def produce_parameter_map_macro(node, param_name):
     
     with open(output_path, 'w') as f:
         print "writing parameter map to file %s ..." % (output_path),
-        for x in node.parents:
-            try:
-                fi = open(os.path.join(x.exp_results, 'out'), 'r')
-            except IOError:
-                print "Error: could not open output file '%s' from job '%s'" % (os.path.join(x.exp_results, 'out'), x.info['description'])
-                exit(1)
-            param_val = list(fi)[0].strip()
-            fi.close()
+        for x, param_val in first_lines(node.parents, 'out', 'output'):
             f.write(str(x.params[param_name])+' '+ param_val)
             f.write('\n')
         f.close()
@@ -50,12 +82,7 @@ def produce_all_map_macro(node, infile, outfile):
     header=False
     with open(output_path, 'w') as f:
         print "writing parameter map to file %s ..." % (output_path),
-        for x in node.parents:
-            try:
-                fi = open(os.path.join(x.exp_results, infile), 'r')
-            except IOError:
-                print "Error: could not open input file '%s' from job '%s'" % (os.path.join(x.exp_results, infile), x.info['description'])
-                exit(1)
+        for x, param_val in first_lines(node.parents, infile, 'input'):
             if not header:
                 f.write('# ')
                 for param_key in x.params:
@@ -69,8 +96,6 @@ def produce_all_map_macro(node, infile, outfile):
                     f.write('"'+val+'" ')
                 else:
                     f.write(str(val)+' ')
-            param_val = list(fi)[0].strip()
-            fi.close()
             f.write(param_val)
             f.write('\n')
         f.close()
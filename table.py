@@ -0,0 +1,182 @@
+import os
+import json
+import urllib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import util, exp_common, exp_index
+
+# table.py: columnar tables of the experiments of one description.
+#
+# export() writes .exp/tables/<description>.npz (with the description
+# percent-encoded) with one row per experiment and these columns:
+#
+#   hash, commit, date, duration, state, return_code
+#   param:<name>     one per parameter of any of the experiments
+#   output:<file>    the first line of <file> in the results directory,
+#                    for each output file asked for
+#
+# Columns whose values are all numbers (or missing) are float arrays, with
+# NaN for missing values; other columns are string arrays, with '' for
+# missing values. In a notebook, numpy.load(path) gives the columns by
+# name.
+#
+# The table also records the position of the index journal it is up to
+# date with (see exp_index.changed_since). The next export only reads the
+# experiments recorded since then (new ones, ones that finished, removed
+# ones), replacing their rows and keeping all others as they are; the
+# whole table is rebuilt when the journal has been rebuilt, or when asked
+# for different output files.
+
+VERSION = 1
+META = '__meta__'
+
+FIXED_COLUMNS = ('hash', 'commit', 'date', 'duration', 'state', 'return_code')
+
+def table_path(description, rootdir=None):
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    if isinstance(description, unicode):
+        description = description.encode('utf-8')
+    name = urllib.quote(description, safe='')
+    return os.path.join(rootdir, exp_common.TABLE_DIR, name + '.npz')
+
+def read_output(results, filename):
+    """The first line of an output file, as a number if it is one"""
+    try:
+        with open(os.path.join(results, filename)) as f:
+            value = f.readline().strip()
+    except IOError:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def row(exp, outputs, resultsdir):
+    r = {'hash': exp.hsh, 'commit': exp.get('commit'), 'date': exp.get('date'),
+         'duration': None, 'state': exp.get('run_state'),
+         'return_code': exp.get('return_code')}
+    if exp.get('date_end') is not None and exp.get('date') is not None:
+        r['duration'] = exp['date_end'] - exp['date']
+    for k, v in (exp.get('params') or {}).iteritems():
+        r['param:' + k] = v
+    results = os.path.join(resultsdir, exp.hsh)
+    for filename in outputs:
+        r['output:' + filename] = read_output(results, filename)
+    return r
+
+def _is_number(v):
+    return v is None or (isinstance(v, (int, long, float)) and not isinstance(v, bool))
+
+def _string(v):
+    if v is None:
+        return ''
+    if isinstance(v, unicode):
+        return v.encode('utf-8')
+    return str(v)
+
+def column(values):
+    if all(_is_number(v) for v in values):
+        return numpy.array([numpy.nan if v is None else v for v in values],
+                           dtype=numpy.float64)
+    return numpy.array([_string(v) for v in values], dtype=str)
+
+def strings(a):
+    """A column as strings, with '' for missing values"""
+    if a.dtype.kind != 'f':
+        return a
+    return numpy.array(['' if numpy.isnan(v) else _string(float(v)) for v in a],
+                       dtype=str)
+
+def missing(n, like):
+    """A column of n missing values, of the same kind as like"""
+    if like.dtype.kind == 'f':
+        return numpy.full(n, numpy.nan)
+    return numpy.zeros(n, dtype=like.dtype)
+
+def merge(old, keep, new):
+    """The rows of the old columns selected by keep, followed by the new
+    ones"""
+    n_old = int(keep.sum())
+    n_new = len(new['hash'])
+    columns = {}
+    for name in set(old) | set(new):
+        a = old[name][keep] if name in old else missing(n_old, new[name])
+        b = new[name] if name in new else missing(n_new, old[name])
+        if (a.dtype.kind == 'f') != (b.dtype.kind == 'f'):
+            # e.g. a parameter that only had numbers until now
+            a, b = strings(a), strings(b)
+        columns[name] = numpy.concatenate([a, b])
+    return columns
+
+def load(path):
+    """The columns and metadata of a table, or None if there is no usable
+    one"""
+    try:
+        with numpy.load(path) as f:
+            columns = dict((name, f[name]) for name in f.files)
+        meta = json.loads(str(columns.pop(META)))
+    except (IOError, KeyError, ValueError):
+        return None
+    if meta.get('version') != VERSION:
+        return None
+    return columns, meta
+
+def save(path, columns, meta):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    columns = dict(columns)
+    columns[META] = numpy.array(json.dumps(meta))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        numpy.savez(f, **columns)
+    os.rename(tmp_path, path)
+
+def export(description, outputs=(), rebuild=False, rootdir=None):
+    """Bring the table of description up to date. Returns its path, the
+    number of rows and the number of rows (re)read."""
+    if numpy is None:
+        print 'exp table needs numpy'
+        exit(1)
+    if rootdir is None:
+        rootdir = util.abs_root_path()
+    outputs = list(outputs)
+    path = table_path(description, rootdir)
+    resultsdir = os.path.join(rootdir, exp_common.RESULTS_DIR)
+
+    old = None if rebuild else load(path)
+    changed = None
+    if old is not None and old[1]['outputs'] == outputs:
+        changed = exp_index.changed_since(tuple(old[1]['position']), rootdir)
+        pos = exp_index.position()
+    if changed is None:
+        old = ({}, None)
+        changed = exp_index.load(rootdir).keys()
+        pos = exp_index.position()
+    # anything recorded after pos is read again next time
+    entries = exp_index.load(rootdir)
+
+    exps = [entries[h] for h in changed
+            if h in entries and entries[h]['description'] == description]
+    exps.sort(key=lambda x: x['date'])
+    rows = [row(exp, outputs, resultsdir) for exp in exps]
+    names = set(FIXED_COLUMNS)
+    for r in rows:
+        names.update(r)
+    new = dict((name, column([r.get(name) for r in rows])) for name in names)
+    new['hash'] = numpy.array([r['hash'] for r in rows], dtype=str)
+
+    old_columns = old[0]
+    if old_columns:
+        keep = ~numpy.in1d(old_columns['hash'], list(changed))
+    else:
+        keep = numpy.zeros(0, dtype=bool)
+    columns = merge(old_columns, keep, new)
+
+    save(path, columns, {'version': VERSION, 'description': description,
+                         'outputs': outputs, 'position': list(pos)})
+    return path, len(columns['hash']), len(rows)
@@ -0,0 +1,133 @@
+import json
+import heapq
+
+# timeline.py: where the time of a run goes.
+#
+# Each job records in info['timing'] when it reached each phase of its
+# life, as seconds since the epoch (see dag_node.mark):
+#
+#   created    the node was made
+#   runnable   its parents had all succeeded
+#   setup      the scheduler started setting up its directories and code
+#   launched   it was handed to the backend
+#   started    the command started running (from its status file; on a
+#   ended      cluster, by the compute node's clock) and exited
+#   finished   the scheduler noticed, freeing its slot
+#   cleaned    its experiment directory was removed
+#
+# Macros, which the scheduler evaluates itself, only get as far as
+# finished. Phases a job didn't get to are missing.
+#
+# write_trace() turns the timings of the jobs of a run into a Chrome
+# trace-event file (load it in chrome://tracing or Perfetto): each job is
+# drawn on a slot lane, split into its setup, queued, run, detect and
+# cleanup phases, with counters of the cores in use and the runnable jobs
+# waiting for a slot.
+
+# (name, from, to) of the segments drawn for each job
+SEGMENTS = [
+    ('setup', 'setup', 'launched'),
+    ('queued', 'launched', 'started'),
+    ('run', 'started', 'ended'),
+    ('detect', 'ended', 'finished'),
+    ('cleanup', 'finished', 'cleaned'),
+]
+
+JOBS_PID = 1
+SCHEDULER_PID = 2
+
+def job(node):
+    """What write_trace needs to know about a node"""
+    return {'hash': node.hsh, 'description': node.info['description'],
+            'macro': node.info.get('code') is not None,
+            'cores': node.resources['cores'],
+            'state': node.info['run_state'],
+            'timing': dict(node.info.get('timing', {}))}
+
+def segments(timing):
+    """The (name, start, end) phases of a job that ran"""
+    if 'started' not in timing or 'ended' not in timing:
+        # no status file: all we know is that it ran until it finished
+        timing = dict(timing, started=timing.get('launched'),
+                      ended=timing.get('finished'))
+    result = []
+    for name, start, end in SEGMENTS:
+        if timing.get(start) is not None and timing.get(end) is not None:
+            result.append((name, timing[start], timing[end]))
+    return result
+
+def _counter(name, deltas, origin):
+    events = []
+    value = 0
+    for t, delta in sorted(deltas):
+        value += delta
+        events.append({'name': name, 'ph': 'C', 'pid': SCHEDULER_PID,
+                       'ts': (t - origin) * 1e6, 'args': {name: value}})
+    return events
+
+def trace_events(jobs, cores=None):
+    times = [t for j in jobs for t in j['timing'].values()]
+    if not times:
+        return []
+    origin = min(times)
+    us = lambda t: (t - origin) * 1e6
+
+    events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': JOBS_PID, 'args': {'name': 'slots'}},
+        {'name': 'process_name', 'ph': 'M', 'pid': SCHEDULER_PID, 'args': {'name': 'scheduler'}},
+        {'name': 'thread_name', 'ph': 'M', 'pid': SCHEDULER_PID, 'tid': 0, 'args': {'name': 'macros'}},
+    ]
+
+    # give each job the first lane free when it was set up
+    ran = [j for j in jobs if not j['macro'] and 'setup' in j['timing']]
+    ran.sort(key=lambda j: j['timing']['setup'])
+    free = []
+    lanes = 0
+    in_use = []
+    waiting = []
+    for j in ran:
+        timing = j['timing']
+        end = max(timing.values())
+        if free and free[0][0] <= timing['setup']:
+            lane = heapq.heappop(free)[1]
+        else:
+            lane = lanes
+            lanes += 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': JOBS_PID,
+                           'tid': lane, 'args': {'name': 'slot {}'.format(lane)}})
+        heapq.heappush(free, (end, lane))
+
+        args = {'hash': j['hash'], 'description': j['description'],
+                'cores': j['cores'], 'state': j['state']}
+        for name, start, stop in segments(timing):
+            events.append({'name': j['description'] if name == 'run' else name,
+                           'cat': name, 'ph': 'X', 'pid': JOBS_PID, 'tid': lane,
+                           'ts': us(start), 'dur': us(stop) - us(start), 'args': args})
+
+        job_cores = min(j['cores'], cores) if cores else j['cores']
+        in_use.append((timing['setup'], job_cores))
+        in_use.append((timing.get('finished', end), -job_cores))
+        if 'runnable' in timing:
+            waiting.append((timing['runnable'], 1))
+            waiting.append((timing['setup'], -1))
+
+    for j in jobs:
+        timing = j['timing']
+        if j['macro'] and 'launched' in timing and 'finished' in timing:
+            events.append({'name': j['description'], 'cat': 'macro', 'ph': 'X',
+                           'pid': SCHEDULER_PID, 'tid': 0, 'ts': us(timing['launched']),
+                           'dur': us(timing['finished']) - us(timing['launched']),
+                           'args': {'hash': j['hash'], 'state': j['state']}})
+
+    events += _counter('cores in use', in_use, origin)
+    events += _counter('runnable jobs', waiting, origin)
+    return events
+
+def write_trace(path, jobs, cores=None):
+    """Write a Chrome trace of jobs (as returned by job) to path. cores is
+    the number of cores the run could use."""
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace_events(jobs, cores),
+                   'displayTimeUnit': 'ms',
+                   'otherData': {'jobs': len(jobs), 'cores': cores}}, f)
+    print 'Wrote a trace of {} jobs to {}'.format(len(jobs), path)
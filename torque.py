@@ -1,50 +1,248 @@
-
-# Blackbox for Torque
-# Untested to the extreme
-from dag import dag_node
 import os
+import sys
+import shlex
 import subprocess
+import pipes
+import re
+import time
+
+import dag, util, exp_common, job_wrapper
+
+# torque.py: a backend running jobs on a Torque (PBS) cluster.
+#
+# Each job is a small bash script in its experiment directory, run by
+# job_wrapper, which puts its output in log and log.err in the results
+# directory, and its exit status in the status file there.
+# Jobs started together with the same resource requests (e.g. the points
+# of a parameter sweep) are submitted as a single job array, so a sweep
+# costs one qsub rather than one per point.
+#
+# The state of all running jobs is found with a single qstat per tick of
+# the scheduler (see refresh), however many jobs are queued: a job qstat
+# still lists is running, and a job it doesn't list is finished once its
+# status file appears. A job that is gone from qstat for MISSING_GRACE
+# seconds without its status file showing up (e.g. because it was
+# deleted) failed; the grace period covers the time a file written on a
+# compute node can take to be seen on this one over NFS.
+#
+# Unless --max-cores is given, up to MAX_JOBS cores' worth of jobs are
+# kept in the queue at once (EXP_QSUB_MAX_JOBS), rather than as many as
+# this machine has cores: the cluster's scheduler decides when they run.
+#
+# The commands used can be changed with the EXP_QSUB and EXP_QSTAT
+# environment variables (e.g. to add options), and EXP_QSUB_OPTIONS is
+# passed on to every qsub. The repository must be on a filesystem shared
+# with the compute nodes.
+#
+# fake_torque/qsub and fake_torque/qstat stand in for Torque on a single
+# machine, running the jobs in the background, for testing:
+#
+#   EXP_QSUB=$PWD/fake_torque/qsub EXP_QSTAT=$PWD/fake_torque/qstat \
+#       parse.py runfile --backend torque tasks.txt
+
+QSUB = 'qsub'
+# -t lists the members of job arrays separately
+QSTAT = 'qstat -t'
+
+MAX_ARRAY_SIZE = 1000
+MAX_JOBS = 1000
+# seconds
+MISSING_GRACE = 60
+
+def _command(var, default):
+    return shlex.split(os.environ.get(var, default))
+
+def _job_key(jobid):
+    """The part of a job id that qstat prints in full: the job number and
+    array index, without the server name"""
+    return jobid.strip().split('.', 1)[0]
+
+def _job_name(node):
+    # PBS only allows short names of a few characters
+    return re.sub('[^A-Za-z0-9_.-]', '_', node.desc or 'exp')[:15]
+
+class torque_backend:
+
+    def __init__(self):
+        self.qsub = _command('EXP_QSUB', QSUB)
+        self.qstat = _command('EXP_QSTAT', QSTAT)
+        self.options = shlex.split(os.environ.get('EXP_QSUB_OPTIONS', ''))
+        self.max_jobs = int(os.environ.get('EXP_QSUB_MAX_JOBS', MAX_JOBS))
+
+        # keys of the jobs listed by the last qstat, and how many times
+        # qstat has been run
+        self.queued = set()
+        self.polls = 0
+        # job key -> polls when submitted / when it was first found gone
+        # without a status file
+        self.submitted = {}
+        self.missing = {}
+        # job array script -> keys of its unfinished members
+        self.arrays = {}
+
+    def budget(self):
+        return {'cores': self.max_jobs, 'memory': 0}
+
+    def write_job_script(self, node):
+        """Write the script to submit for node: the job's command, run by
+        job_wrapper"""
+        command = os.path.join(node.expdir, node.hsh + '.sh')
+        filename = os.path.join(node.expdir, node.hsh + '.job')
+        cwd = os.path.join(node.expdir, node.working_dir)
+        q = pipes.quote
+
+        with open(command, 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write('export PATH=$PATH:{}\n'.format(q(cwd)))
+            f.write('export EXP_RESULTS_DIR={}\n'.format(q(node.exp_results)))
+            if len(node.parents) == 1:
+                f.write('export EXP_PARENT_RESULTS_DIR={}\n'
+                        .format(q(list(node.parents)[0].exp_results)))
+            f.write(node.new_cmd + '\n')
+
+        with open(filename, 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write('cd {}\n'.format(q(cwd)))
+            # python must be at the same path on the compute nodes
+            f.write('exec {} {} {} {}\n'.format(q(sys.executable), q(job_wrapper.SCRIPT),
+                                                q(node.exp_results), q(command)))
+        os.chmod(command, 0700)
+        os.chmod(filename, 0700)
+        return filename
+
+    def resource_options(self, node):
+        cores = node.resources['cores']
+        options = ['-l', 'nodes=1:ppn={}'.format(cores)]
+        if node.resources['memory']:
+            options += ['-l', 'mem={}mb'.format(node.resources['memory'])]
+        if node.resources['exclusive']:
+            options.append('-n')
+        return options
+
+    def submit(self, name, script, options):
+        cmd = (self.qsub + ['-N', name, '-o', '/dev/null', '-e', '/dev/null'] +
+               options + self.options + [script])
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            out = p.communicate()[0]
+        except OSError as e:
+            print 'Could not run {}: {}'.format(cmd[0], e.strerror)
+            exit(1)
+        if p.returncode != 0 or not out.strip():
+            print 'Submitting {} failed'.format(script)
+            exit(1)
+        return out.strip()
+
+    def run(self, node):
+        self.run_many([node])
+        return node.jobid
+
+    def run_many(self, nodes):
+        """Submit a batch of jobs, as one job array per distinct resource
+        request"""
+        groups = {}
+        for node in nodes:
+            options = tuple(self.resource_options(node))
+            groups.setdefault(options, []).append(node)
+
+        for options, group in groups.iteritems():
+            for i in range(0, len(group), MAX_ARRAY_SIZE):
+                self.submit_array(group[i:i + MAX_ARRAY_SIZE], list(options))
+
+    def submit_array(self, nodes, options):
+        scripts = [self.write_job_script(n) for n in nodes]
+        for n in nodes:
+            print 'Submitting command ' + n.new_cmd
+
+        if len(nodes) == 1:
+            jobids = [self.submit(_job_name(nodes[0]), scripts[0], options)]
+        else:
+            rootdir = util.abs_root_path()
+            array_script = os.path.join(
+                rootdir, exp_common.EXP_DIR,
+                'array-{}.sh'.format(util.sha1(''.join(n.hsh for n in nodes))[:12]))
+            with open(array_script, 'w') as f:
+                f.write('#!/bin/bash\n')
+                f.write('case "${PBS_ARRAYID:-$PBS_ARRAY_INDEX}" in\n')
+                for i, script in enumerate(scripts):
+                    f.write('{}) exec {} ;;\n'.format(i, pipes.quote(script)))
+                f.write('esac\nexit 1\n')
+            os.chmod(array_script, 0700)
+
+            # qsub prints the id of the array as <number>[].<server>
+            arrayid = self.submit(_job_name(nodes[0]), array_script,
+                                  options + ['-t', '0-{}'.format(len(nodes) - 1)])
+            number, server = arrayid.split('[]', 1)
+            jobids = ['{}[{}]{}'.format(number, i, server)
+                      for i in range(len(nodes))]
+            self.arrays[array_script] = set(_job_key(j) for j in jobids)
+
+        for node, jobid in zip(nodes, jobids):
+            node.jobid = jobid
+            self.submitted[_job_key(jobid)] = self.polls
+
+    def refresh(self, nodes):
+        """Find out which jobs are still queued or running, with one qstat
+        for all of them. Called by the scheduler once per tick."""
+        try:
+            p = subprocess.Popen(self.qstat, stdout=subprocess.PIPE)
+            out = p.communicate()[0]
+        except OSError as e:
+            print 'Could not run {}: {}'.format(self.qstat[0], e.strerror)
+            return
+        if p.returncode != 0:
+            # keep what we knew; no job is judged missing on a failed poll
+            return
+
+        queued = set()
+        for line in out.splitlines():
+            fields = line.split()
+            # skip the header lines
+            if len(fields) < 5 or fields[0] == 'Job' or fields[0].startswith('-'):
+                continue
+            # the state is the second to last column; C means completed
+            if fields[-2] != 'C':
+                queued.add(_job_key(fields[0]))
+        self.queued = queued
+        self.polls += 1
+
+    def finished(self, key):
+        self.submitted.pop(key, None)
+        self.missing.pop(key, None)
+        for script, keys in self.arrays.items():
+            keys.discard(key)
+            if not keys:
+                del self.arrays[script]
+                try:
+                    os.remove(script)
+                except OSError:
+                    pass
+
+    def get_state(self, node):
+        if node.info['run_state'] != dag.RUN_STATE_RUNNING:
+            return node.info['run_state'], node.info['return_code']
 
-default_options='-N {} -r n -e {} -o {} -d {} -lnodes=1:ppn=1' 
-launch_command='qsub '
-
-class Torque_blackbox:
-    #write a bash cscript. Basically prints out exit status 
-    def write_bash_script(self, filename, command):
-	f=open(filename, 'w')
-	f.write('#!/bin/bash\n')
-	f.write('./' +command+'\n')
-	f.write('echo  $?\n')
-	f.close()
-
-    def run(node, options=default_options):
-
-	#Fill in options
-	options2=options.format(node.hsh, os.path.join(node.exp_path, 'err'), os.path.join(node.exp_path, 'log'), os.path.join(node.expdir, node.working_dir))
-
-	#Write bash script
-	filename=os.path.join(node.expdir, node.hsh+'.sh')
-	write_bash_script(filename, command)
-	os.system('chmod 700 '+filename)
-
-	#launch job
-	qsub_command=launch_command+options2+filename
-	pipe=subprocess.Popen(qsub_command, stdout=subprocess.PIPE)
-	node.job_id=pipe.read().strip
- 
-    def get_state(node):
-        #The code that calls this will need to update the info file of the job.
-	qstat_command='qstat | grep \'{}\''.format(node.job_id)
-	canfind=os.system(qstat_command)
-        if(not canfind):
-            logfile=os.path.join(node.exp_path, 'log')
-            with open(logfile) as f:
-		status=list(f)[-1]
-	    if(status == '0'):
-	        return RUN_STATE_SUCCESS
-	    else
-		return RUN_STATE_FAILURE
-	else
-	    return RUN_STATE_RUNNING
+        key = _job_key(node.jobid)
+        if key in self.queued or self.submitted.get(key) == self.polls:
+            # still in the queue, or submitted since the last qstat
+            return dag.RUN_STATE_RUNNING, None
 
+        info = job_wrapper.read_status(node.exp_results)
+        if info is None:
+            # the status file may take a while to show up on a shared
+            # filesystem
+            gone = self.missing.setdefault(key, time.time())
+            if time.time() - gone < MISSING_GRACE:
+                return dag.RUN_STATE_RUNNING, None
+            print "Job %s for command '%s' disappeared without an exit status" \
+                % (node.jobid, node.new_cmd)
+            self.finished(key)
+            return dag.RUN_STATE_FAIL, None
 
+        self.finished(key)
+        status = info['return_code']
+        print "Command '%s' exited with status %d." % (node.new_cmd, status)
+        node.info['date_end'] = info['end']
+        if status == 0:
+            return dag.RUN_STATE_SUCCESS, status
+        return dag.RUN_STATE_FAIL, status
@@ -2,6 +2,7 @@ import subprocess
 import os
 import time
 import hashlib
+import multiprocessing
 
 
 # Shortcuts for running shell commands
@@ -19,8 +20,46 @@ def exec_output(args):
 
 
 
+# Git access. The repository root is only looked up once per process,
+# and commit expressions are resolved through a single long-lived
+# 'git cat-file --batch-check' process (with a cache in front of it),
+# rather than forking git for every lookup.
+
+_root_path = None
+_git_batch = None
+_commits = {}
+
 def abs_root_path():
-    return exec_output(['git', 'rev-parse', '--show-toplevel']).strip()
+    global _root_path
+    if _root_path is None:
+        _root_path = exec_output(['git', 'rev-parse', '--show-toplevel']).strip()
+    return _root_path
+
+def rev_parse(expr):
+    """Return the hash of the commit named by expr, or None if there is no
+    such commit"""
+    global _git_batch
+
+    if expr in _commits:
+        return _commits[expr]
+
+    if _git_batch is None or _git_batch.poll() is not None:
+        _git_batch = subprocess.Popen(['git', 'cat-file', '--batch-check'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      cwd=abs_root_path())
+
+    # peel tags so that we always get a commit; the reply is either
+    # '<hash> commit <size>' or '<expr> missing'
+    _git_batch.stdin.write(expr + '^{commit}\n')
+    _git_batch.stdin.flush()
+    reply = _git_batch.stdout.readline().split()
+
+    if len(reply) == 3 and reply[1] == 'commit':
+        _commits[expr] = reply[0]
+    else:
+        _commits[expr] = None
+    return _commits[expr]
 
 def sha1(s):
     return hashlib.sha1(s).hexdigest()
@@ -30,3 +69,61 @@ def trunc(s, n):
         return s
     else:
         return s[:n] + '..'
+
+# Resource requests and budgets. Memory is always in megabytes.
+
+SIZE_UNITS = {'k': 1.0 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}
+
+def parse_size(s):
+    """Parse a memory size such as '512', '512M' or '2G' into megabytes"""
+    s = str(s).strip().lower()
+    if s.endswith('b'):
+        s = s[:-1]
+    if s and s[-1] in SIZE_UNITS:
+        return int(float(s[:-1]) * SIZE_UNITS[s[-1]])
+    return int(float(s))
+
+def parse_resources(spec):
+    """Parse a resource request of the form 'cores=4, memory=2G, exclusive'
+    into a dictionary"""
+    resources = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            k, v = [x.strip() for x in item.split('=', 1)]
+        else:
+            k, v = item, True
+        if k == 'cores':
+            resources['cores'] = int(v)
+        elif k in ('memory', 'mem'):
+            resources['memory'] = parse_size(v)
+        elif k == 'exclusive':
+            resources['exclusive'] = v is True or v.lower() in ('1', 'true', 'yes')
+        else:
+            raise ValueError('unknown resource \'{}\''.format(k))
+    return resources
+
+def machine_resources():
+    """The cores and memory of this machine, to use as the default budget"""
+    try:
+        cores = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cores = 1
+    try:
+        memory = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+                  // (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        memory = 0
+    return {'cores': cores, 'memory': memory}
+
+def resource_budget(max_cores=None, max_memory=None):
+    """The budget to schedule jobs against: the machine's resources, unless
+    overridden"""
+    budget = machine_resources()
+    if max_cores is not None:
+        budget['cores'] = int(max_cores)
+    if max_memory is not None:
+        budget['memory'] = parse_size(max_memory)
+    return budget